@@ -0,0 +1,192 @@
+"""Times the stages of the transform on synthetic tables, see generate.py.
+
+    python bench/benchmark.py --rows 10000 --rows 100000 --rows 1000000 --results results.json
+    python bench/benchmark.py --rows 10000 --compare results.json
+
+Each stage runs in a fresh process, its peak_rss_bytes is the peak of the process up to the end of the stage.
+normalize, fhirized and serialize stream the table, the seconds of a stage exclude the stages feeding it.
+"""
+import concurrent.futures
+import datetime
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+import click
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+
+import generate  # noqa: E402
+import model  # noqa: E402
+import writer  # noqa: E402
+
+SCHEMA = os.path.join(BENCH_DIR, "HTAN.model.jsonld")
+STAGES = ["schema_cold", "schema", "normalize", "fhirized", "serialize"]
+
+
+def _timed(iterable, clock: list):
+    """Yield from the iterable, adding the time spent in it to clock[0]."""
+    iterator = iter(iterable)
+    while True:
+        start = time.perf_counter()
+        try:
+            item = next(iterator)
+        except StopIteration:
+            clock[0] += time.perf_counter() - start
+            return
+        clock[0] += time.perf_counter() - start
+        yield item
+
+
+def run_stage(stage, data_path, schema_path, encoder_name="json") -> dict:
+    """Run the transform up to the stage, return its seconds and the number of items it produced."""
+    if stage in ("schema_cold", "schema"):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            if stage == "schema":
+                model.HTANSchema(schema_path, cache_dir=cache_dir)
+            start = time.perf_counter()
+            model.HTANSchema(schema_path, cache_dir=cache_dir)
+            return {'seconds': time.perf_counter() - start, 'items': 1}
+
+    assay_resolver = model.AssayResolver(model.HTANSchema(schema_path), log=lambda msg: None)
+    normalizing = [0.0]
+    rows = _timed(model.normalize(data_path, assay_resolver=assay_resolver, flat=True), normalizing)
+    if stage == "normalize":
+        items = sum(1 for _ in rows)
+        return {'seconds': normalizing[0], 'items': items}
+
+    # as main() does
+    emitted_already = set()
+    fhirizing = [0.0]
+    resources = _timed(model.fhir_resources(rows, emitted_already), fhirizing)
+    items = 0
+    serializing = 0.0
+    dumps = writer.encoder(encoder_name)
+    for _ in resources:
+        if _['id'] in emitted_already:
+            continue
+        emitted_already.add(_['id'])
+        items += 1
+        if stage == "serialize":
+            start = time.perf_counter()
+            model.serialized(_, None, dumps)
+            serializing += time.perf_counter() - start
+    if stage == "fhirized":
+        return {'seconds': fhirizing[0] - normalizing[0], 'items': items}
+    return {'seconds': serializing, 'items': items}
+
+
+def _run_stage(stage, data_path, schema_path, encoder_name) -> dict:
+    result = run_stage(stage, data_path, schema_path, encoder_name)
+    # ru_maxrss is KiB on linux, bytes on macOS
+    scale = 1 if sys.platform == "darwin" else 1024
+    result['peak_rss_bytes'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+    return result
+
+
+def measure(stage, data_path, schema_path, encoder_name="json") -> dict:
+    """Run the stage in a fresh process."""
+    with concurrent.futures.ProcessPoolExecutor(1, mp_context=multiprocessing.get_context("spawn")) as executor:
+        return executor.submit(_run_stage, stage, data_path, schema_path, encoder_name).result()
+
+
+def table(rows, data_dir, seed=0) -> str:
+    """Return the path of a synthetic table of rows, generated once per rows and seed."""
+    os.makedirs(data_dir, exist_ok=True)
+    path = os.path.join(data_dir, f"table_data.{rows}.{seed}.tsv")
+    if not os.path.exists(path):
+        with open(path + ".tmp", "w", newline="") as f:
+            generate.generate(f, rows, seed=seed)
+        os.replace(path + ".tmp", path)
+    return path
+
+
+def version() -> dict:
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], cwd=BENCH_DIR, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {'commit': commit, 'python': platform.python_version(), 'platform': platform.platform(), 'cpu_count': os.cpu_count()}
+
+
+def benchmark(sizes, stages=STAGES, schema_path=SCHEMA, data_dir=None, encoder_name="json", repeat=1, seed=0, log=None) -> dict:
+    """Time the stages on tables of each size, best of repeat runs."""
+    data_dir = data_dir or os.path.join(BENCH_DIR, "data")
+    results = []
+    for rows in sizes:
+        data_path = table(rows, data_dir, seed)
+        for stage in stages:
+            runs = [measure(stage, data_path, schema_path, encoder_name) for _ in range(repeat)]
+            best = min(runs, key=lambda _: _['seconds'])
+            result = {
+                'stage': stage,
+                'rows': rows,
+                'seconds': round(best['seconds'], 6),
+                'rows_per_second': round(rows / best['seconds']) if best['seconds'] and stage not in ("schema_cold", "schema") else None,
+                'items': best['items'],
+                'items_per_second': round(best['items'] / best['seconds']) if best['seconds'] else None,
+                'peak_rss_bytes': max(_['peak_rss_bytes'] for _ in runs),
+            }
+            if log:
+                log(result)
+            results.append(result)
+    return {
+        'created': datetime.datetime.now(datetime.timezone.utc).isoformat(timespec='seconds'),
+        'version': version(),
+        'parameters': {'schema': os.path.relpath(schema_path, BENCH_DIR), 'encoder': encoder_name, 'repeat': repeat, 'seed': seed},
+        'results': results,
+    }
+
+
+def compare(previous: dict, current: dict, threshold=0.1) -> list[str]:
+    """Return a line per (stage, rows) of both runs, flagging those slower by more than threshold."""
+    before = {(_['stage'], _['rows']): _ for _ in previous['results']}
+    lines = []
+    for _ in current['results']:
+        old = before.get((_['stage'], _['rows']), None)
+        if not old or not old['seconds']:
+            continue
+        ratio = _['seconds'] / old['seconds']
+        flag = "  SLOWER" if ratio > 1 + threshold else ""
+        lines.append(f"{_['stage']:<12} {_['rows']:>9} {old['seconds']:>10.3f}s {_['seconds']:>10.3f}s {ratio:>6.2f}x{flag}")
+    return lines
+
+
+@click.command()
+@click.option('--rows', 'sizes', multiple=True, type=click.IntRange(min=1), help="Rows of a table, repeat for each size [default: 10000 100000 1000000].")
+@click.option('--stage', 'stages', multiple=True, type=click.Choice(STAGES), help="Stage to time, repeat for each [default: all].")
+@click.option('--schema', 'schema_path', default=SCHEMA, show_default=True, help="HTAN schema (JSON-LD).")
+@click.option('--data-dir', default=None, help="Directory of the generated tables [default: bench/data].")
+@click.option('--encoder', 'encoder_name', default="json", show_default=True, type=click.Choice(["json", "fast"]))
+@click.option('--repeat', default=1, show_default=True, type=click.IntRange(min=1), help="Runs per stage, the fastest is kept.")
+@click.option('--seed', default=0, show_default=True)
+@click.option('--results', 'results_path', default=None, help="Write the results to this json file.")
+@click.option('--compare', 'compare_path', default=None, help="Compare with the results of a previous run.")
+@click.option('--threshold', default=0.1, show_default=True, help="Flag stages slower than the previous run by more than this fraction.")
+def cli(sizes, stages, schema_path, data_dir, encoder_name, repeat, seed, results_path, compare_path, threshold):
+    """Benchmark the transform on synthetic HTAN tables."""
+    def log(result):
+        click.echo(json.dumps(result), err=True)
+
+    current = benchmark(sizes or [10000, 100000, 1000000], stages=stages or STAGES, schema_path=schema_path, data_dir=data_dir,
+                        encoder_name=encoder_name, repeat=repeat, seed=seed, log=log)
+    if results_path:
+        with open(results_path, "w") as f:
+            json.dump(current, f, indent=2)
+    if compare_path:
+        with open(compare_path) as f:
+            previous = json.load(f)
+        click.echo(f"{'stage':<12} {'rows':>9} {'previous':>11} {'current':>11}  ratio")
+        for line in compare(previous, current, threshold):
+            click.echo(line)
+
+
+if __name__ == '__main__':
+    cli()
@@ -0,0 +1,99 @@
+"""Generates synthetic HTAN metadata tables for the stand-in schema bench/HTAN.model.jsonld, see benchmark.py."""
+import csv
+import random
+import sys
+
+import click
+
+COLUMNS = ["HTAN Participant ID", "Biospecimen", "HTAN Parent Biospecimen ID", "HTAN Data File ID", "Filename", "File Format",
+           "Assay", "Level", "Atlas ID", "Organ", "Data Access", "Synapse Id", "Library Construction Method",
+           "Imaging Segmentation Method", "Comment"]
+
+# (Assay, Level) = weight. scRNA-seq and CyCIF are assays of the schema, Bulk RNA-seq and RPPA are
+# data types (not assays) and Bulk DNA is not in the schema, the transform creates ohsu: assays for them
+ASSAY_MIX = {
+    ("scRNA-seq", "Level 1"): 25,
+    ("scRNA-seq", "Level 2"): 20,
+    ("CyCIF", "Level 2"): 20,
+    ("Bulk RNA-seq", "Level 1"): 10,
+    ("RPPA", "Level 2"): 5,
+    ("Bulk DNA", "Level 1"): 10,
+    ("Bulk DNA", "Level 2"): 10,
+}
+
+FILE_FORMATS = {"scRNA-seq": ["fastq", "bam"], "CyCIF": ["OME-TIFF"], "Bulk RNA-seq": ["fastq", "bam"], "RPPA": ["csv"], "Bulk DNA": ["bam", "vcf"]}
+
+
+def parse_mix(mix: list[str]) -> dict:
+    """Parse Assay:Level=weight strings, e.g. 'Bulk DNA:Level 1=10'."""
+    parsed = {}
+    for _ in mix:
+        assay_level, weight = _.rsplit('=', 1)
+        assay, level = assay_level.split(':', 1)
+        parsed[(assay, level)] = float(weight)
+    return parsed
+
+
+def rows(count, participants=100, biospecimens=10, assay_mix=None, center="HTA9", missing_participant=0.2,
+         two_biospecimens=0.05, seed=0):
+    """Yield count synthetic table rows, one data file each.
+    Files belong to a random biospecimen of a random participant, missing_participant of the rows leave the participant
+    to be derived from the biospecimen, and two_biospecimens of them list two biospecimens, as the HTAN tables do.
+    """
+    assay_mix = assay_mix or ASSAY_MIX
+    rng = random.Random(seed)
+    assays = list(assay_mix)
+    weights = list(assay_mix.values())
+    for i in range(count):
+        participant = f"{center}_{rng.randrange(participants)}"
+        b = rng.randrange(biospecimens)
+        biospecimen = f"{participant}_{b}"
+        if rng.random() < two_biospecimens:
+            biospecimen = f"{biospecimen}, {participant}_{b + 1}"
+        assay, level = rng.choices(assays, weights)[0]
+        file_format = rng.choice(FILE_FORMATS.get(assay, ["bam"]))
+        yield {
+            "HTAN Participant ID": "" if rng.random() < missing_participant else participant,
+            "Biospecimen": biospecimen,
+            "HTAN Parent Biospecimen ID": f"{participant}_{b}" if rng.random() < 0.9 else "",
+            "HTAN Data File ID": f"{participant}_{b}_{i}",
+            "Filename": f"{assay.replace(' ', '_')}/{participant}_{b}_{i}.{file_format.lower()}",
+            "File Format": file_format,
+            "Assay": assay,
+            "Level": level,
+            "Atlas ID": center,
+            "Organ": rng.choice(["Breast", "Lung", ""]),
+            "Data Access": rng.choice(["open", "controlled"]),
+            "Synapse Id": f"syn{20000000 + i}",
+            "Library Construction Method": "10x" if assay == "scRNA-seq" else "",
+            "Imaging Segmentation Method": "mesmer" if assay == "CyCIF" and rng.random() < 0.5 else "",
+            "Comment": "QC passed" if rng.random() < 0.3 else "",
+        }
+
+
+def generate(file, count, **kwargs):
+    """Write a tsv table of count rows to the file, see rows()."""
+    writer = csv.DictWriter(file, fieldnames=COLUMNS, delimiter='\t', lineterminator='\n')
+    writer.writeheader()
+    writer.writerows(rows(count, **kwargs))
+
+
+@click.command()
+@click.option('--rows', 'count', default=10000, show_default=True, type=click.IntRange(min=0), help="Rows of the table.")
+@click.option('--participants', default=100, show_default=True, type=click.IntRange(min=1))
+@click.option('--biospecimens', default=10, show_default=True, type=click.IntRange(min=1), help="Biospecimens per participant.")
+@click.option('--assay', 'mix', multiple=True, help="Assay mix, 'Assay:Level=weight', repeat for each assay [default: ASSAY_MIX].")
+@click.option('--seed', default=0, show_default=True)
+@click.option('--output', 'output_path', default="-", show_default=True, help="Path of the tsv, - for stdout.")
+def cli(count, participants, biospecimens, mix, seed, output_path):
+    """Generate a synthetic HTAN metadata table."""
+    kwargs = dict(participants=participants, biospecimens=biospecimens, assay_mix=parse_mix(mix) if mix else None, seed=seed)
+    if output_path == "-":
+        generate(sys.stdout, count, **kwargs)
+        return
+    with open(output_path, "w", newline="") as f:
+        generate(f, count, **kwargs)
+
+
+if __name__ == '__main__':
+    cli()
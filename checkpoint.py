@@ -0,0 +1,94 @@
+"""Checkpoints of a run of model.main(), to resume it where it stopped, see model.main(checkpoint_rows=...)."""
+import contextlib
+import json
+import os
+import sys
+
+CHECKPOINT = "checkpoint.json"
+# the ids emitted, a line each, appended at each checkpoint
+IDS = "checkpoint.ids"
+
+
+def _fsync_replace(path, data: str):
+    with open(path + ".tmp", "w") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(path + ".tmp", path)
+
+
+class Checkpoint:
+    """Saves the position in the input tables, the ids emitted and the state of the writer's files every_rows rows.
+    The position is (index of the table, rows of it done), a run's rows are done when their resources are written.
+    The parameters of the run are saved with it, a resumed run must have the same ones.
+    """
+    def __init__(self, output_path, writer, parameters: dict, every_rows=100000, log=None):
+        self.path = os.path.join(output_path, CHECKPOINT)
+        self.ids_path = os.path.join(output_path, IDS)
+        self.writer = writer
+        self.parameters = parameters
+        self.every_rows = every_rows
+        self.log = log or (lambda msg: print(msg, file=sys.stderr))
+        self.rows = 0
+        # ids emitted since the last save
+        self.ids = []
+        self.saved = 0
+
+    def add(self, _id):
+        """Add an emitted id."""
+        self.ids.append(_id)
+
+    def advance(self, position: tuple[int, int], rows=1):
+        """Called with the position of the next row after rows more are done, saves a checkpoint every every_rows rows."""
+        self.rows += rows
+        if self.rows >= self.every_rows:
+            self.save(position)
+
+    def save(self, position: tuple[int, int]):
+        files = self.writer.checkpoint()
+        with open(self.ids_path, "a") as f:
+            f.write(''.join(f"{_}\n" for _ in self.ids))
+            f.flush()
+            os.fsync(f.fileno())
+            ids_bytes = f.tell()
+        _fsync_replace(self.path, json.dumps({
+            'parameters': self.parameters,
+            'position': list(position),
+            'ids_bytes': ids_bytes,
+            'files': files,
+        }))
+        self.ids = []
+        self.rows = 0
+        self.saved += 1
+
+    def start(self):
+        """Remove the checkpoint of a previous run, for a new one."""
+        for path in (self.path, self.ids_path):
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(path)
+
+    def restore(self, emitted_already) -> tuple[int, int]:
+        """Restore the writer's files and the ids emitted of the last checkpoint, return its position.
+        Without a checkpoint, the run starts over from (0, 0).
+        """
+        if not os.path.exists(self.path):
+            self.log(f"No {self.path}, starting over")
+            self.start()
+            self.writer.clear()
+            return 0, 0
+        with open(self.path) as f:
+            saved = json.load(f)
+        if saved['parameters'] != self.parameters:
+            raise ValueError(f"{self.path} is the checkpoint of a run with other parameters: {saved['parameters']}")
+        with open(self.ids_path, "r+") as f:
+            f.truncate(saved['ids_bytes'])
+            for line in f:
+                emitted_already.add(line[:-1])
+        self.writer.resume(saved['files'])
+        position = tuple(saved['position'])
+        self.log(f"Resuming from table {position[0]}, row {position[1]}")
+        return position
+
+    def done(self):
+        """Remove the checkpoint of a run completed."""
+        self.start()
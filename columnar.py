@@ -0,0 +1,320 @@
+"""Column-wise normalization and FHIR-ization of a table, the batch alternative to model.normalize() and model.fhir_resources().
+
+The table is read in batches of columns. The participant backfill, the assay resolution, the cells and the
+content dependent mappings are computed once per column, or once per distinct value of a column, and the values
+a resource reads (ids, references, file attributes) as whole columns. Resources are then built row by row
+from those columns, in the order fhir_resources() yields them, so the output is the same as the row path's.
+"""
+import csv
+import itertools
+import os
+
+import model
+from model import (BIOSPECIMEN, CENTER, DATA_TYPE, FILE, PATIENT, SKIPPED, THING_CLASSES, ColumnPlan, Row, merged_entries,
+                   nested_children)
+from report import RunReport
+
+# the paths of the values read as columns
+PARTICIPANT_ID = PATIENT + ('bts:HTANParticipantID',)
+BIOSPECIMEN_ID = BIOSPECIMEN + ('bts:HTANBiospecimenID',)
+BIOSPECIMEN_PARTICIPANT_ID = BIOSPECIMEN + ('bts:HTANParticipantID',)
+PARENT_BIOSPECIMEN_ID = BIOSPECIMEN + ('bts:HTANParentBiospecimenID',)
+FILE_ID = FILE + ('bts:HTANDataFileID',)
+SYNAPSE_ID = FILE + ('bts:SynapseID',)
+DATA_ACCESS = FILE + ('bts:DataAccess',)
+FILENAME = ('bts:Thing', 'bts:Filename')
+FILE_FILENAME = FILE + ('bts:Filename',)
+FILE_FORMAT = ('bts:Thing', 'bts:FileFormat')
+FILE_FILE_FORMAT = FILE + ('bts:FileFormat',)
+
+ARROW_EXTENSIONS = ('.parquet', '.arrow', '.feather')
+
+
+def _arrow_batches(batches):
+    """Yield the columns and rows (lists of strings, '' for null) of pyarrow RecordBatches."""
+    import pyarrow
+    for batch in batches:
+        data = [['' if _ is None else _ for _ in column.cast(pyarrow.string()).to_pylist()] for column in batch.columns]
+        yield list(batch.schema.names), data
+
+
+def read_batches(source, batch_size=10000):
+    """Yield the columns and the data (a list of values per column) of batches of a table's rows.
+    The source is a tsv as in model.table_rows(), a Parquet (.parquet) or Arrow IPC (.arrow, .feather) file,
+    or a pyarrow Table. Parquet and Arrow need pyarrow.
+    """
+    if hasattr(source, 'to_batches'):
+        yield from _arrow_batches(source.to_batches(max_chunksize=batch_size))
+        return
+    if isinstance(source, (str, os.PathLike)) and str(source).endswith(ARROW_EXTENSIONS):
+        try:
+            import pyarrow.ipc
+            import pyarrow.parquet
+        except ImportError:
+            raise ValueError(f"Reading {source} needs the pyarrow package, pip install pyarrow")
+        if str(source).endswith('.parquet'):
+            yield from _arrow_batches(pyarrow.parquet.ParquetFile(source).iter_batches(batch_size=batch_size))
+            return
+        with pyarrow.ipc.open_file(source) as reader:
+            yield from _arrow_batches(reader.get_batch(_) for _ in range(reader.num_record_batches))
+        return
+    with model.open_table(source) as file:
+        reader = csv.reader(file, delimiter='\t')
+        columns = next(reader, None)
+        if not columns:
+            return
+        width = len(columns)
+        # as csv.DictReader: blank lines are skipped, missing cells are None, extra ones dropped
+        rows = (_ if len(_) == width else (_ + [None] * (width - len(_)))[:width] for _ in reader if _)
+        while True:
+            batch = list(itertools.islice(rows, batch_size))
+            if not batch:
+                return
+            yield columns, [list(_) for _ in zip(*batch)]
+
+
+class ColumnBatch:
+    """A batch of a table's rows, normalized column-wise. See Row for the semantics of the cells and values."""
+    def __init__(self, plan: ColumnPlan, columns, data, assay_resolver, skip_empty=True):
+        self.plan = plan
+        self.columns = columns
+        self.index = {column: j for j, column in enumerate(columns)}
+        self.size = len(data[0]) if data else 0
+        self.data = data
+        self.skip_empty = skip_empty
+        # the participant of rows without one is their (first) biospecimen's
+        participants = data[self.index['HTAN Participant ID']]
+        biospecimens = data[self.index['Biospecimen']]
+        backfilled = {}
+        for i, participant in enumerate(participants):
+            if participant == '':
+                biospecimen = biospecimens[i]
+                participant = backfilled.get(biospecimen, None)
+                if participant is None:
+                    participant = backfilled[biospecimen] = '_'.join(biospecimen.split(',')[0].replace(" ", "").split('_')[:-1])
+                participants[i] = participant
+        self.participants = participants
+        # the assay of each row, resolved once per (Assay, Level)
+        levels = data[self.index['Level']] if 'Level' in self.index else itertools.repeat(None)
+        resolved = {}
+        self.assays = [
+            resolved[_] if _ in resolved else resolved.setdefault(_, assay_resolver.resolve(*_))
+            for _ in zip(data[self.index['Assay']], levels)
+        ]
+        # the cells of each column
+        if skip_empty:
+            self.cells = [[_ if _ else SKIPPED for _ in column] for column in data]
+        else:
+            self.cells = [[_ if _ else None for _ in column] for column in data]
+        # the mappings of the content dependent columns, per distinct cell
+        self.mappings = {}
+        for _, column in plan.content_columns:
+            by_value = {}
+            get = plan.get
+            self.mappings[column] = [
+                None if cell is SKIPPED else (by_value[cell] if cell in by_value else by_value.setdefault(cell, get(column, cell)))
+                for cell in self.cells[self.index[column]]
+            ]
+        # the content entries of each row, None for rows without, like Row.content
+        self.content = [None] * self.size
+        for position, column in plan.content_columns:
+            for i, mapping in enumerate(self.mappings[column]):
+                if mapping:
+                    if self.content[i] is None:
+                        self.content[i] = []
+                    self.content[i].append((position, column, mapping))
+        # the cells and ids of an assay's dependencies, by assay_dependencies
+        self.dependencies = {}
+
+    def cell(self, column, i):
+        j = self.index.get(column, None)
+        if j is None:
+            return SKIPPED if self.skip_empty else None
+        return self.cells[j][i]
+
+    def values(self, path, default) -> list:
+        """Return the value placed at a path of classes in each row, the last cell wins, default (a value or a list) for none."""
+        entries = [(position, column, None) for position, column, _ in self.plan.at_path.get(path, [])]
+        for position, column in self.plan.content_columns:
+            entries.append((position, column, self.mappings[column]))
+        values = [SKIPPED] * self.size
+        for _, column, mappings in sorted(entries, key=lambda _: _[0]):
+            cells = self.cells[self.index[column]]
+            if mappings is None:
+                values = [v if c is SKIPPED else c for v, c in zip(values, cells)]
+            elif any(m and not m.in_assay and m.path == path for m in set(mappings)):
+                values = [c if m and c is not SKIPPED and not m.in_assay and m.path == path else v for v, c, m in zip(values, cells, mappings)]
+        if isinstance(default, list):
+            return [d if v is SKIPPED else v for v, d in zip(values, default)]
+        return [default if v is SKIPPED else v for v in values]
+
+    def _candidates(self, match) -> list[int]:
+        """Return the indexes of the content columns with a mapping that matches, in any row."""
+        return [
+            self.index[column] for _, column in self.plan.content_columns
+            if any(m and match(m) for m in set(self.mappings[column]))
+        ]
+
+    def children(self, prefix) -> list[dict]:
+        """Return the values placed below a path of classes in each row, see Row.children().
+        They only depend on the row's cells of the columns that can be placed there, rows with the same cells share them.
+        """
+        entries = self.plan.under(prefix)
+        depth = len(prefix)
+        columns = sorted({self.index[column] for _, column, _ in entries} | set(self._candidates(
+            lambda m: not m.in_assay and len(m.path) > depth and m.path[:depth] == prefix
+        )))
+        if not columns:
+            return [{}] * self.size
+        by_cells = {}
+        children = []
+        for i, cells in enumerate(zip(*[self.cells[j] for j in columns])):
+            value = by_cells.get(cells, None)
+            if value is None:
+                value = by_cells[cells] = nested_children(merged_entries(entries, self.content[i], prefix=prefix),
+                                                          lambda column: self.cell(column, i), depth)
+            children.append(value)
+        return children
+
+    def assay_values(self, i, participant_id, biospecimen_id, parent_biospecimen_id, data_type) -> dict:
+        """Return the values gathered under the row's assay class, see Row.assay_values()."""
+        values = {}
+        dependencies = self.assays[i].assay_dependencies
+        compiled = self.dependencies.get(dependencies, None)
+        if compiled is None or self.content[i] is not None:
+            for _, column, mapping in merged_entries(self.plan.dependencies(dependencies), self.content[i], ids=dependencies):
+                cell = self.cell(column, i)
+                if cell is not SKIPPED:
+                    values[mapping.id] = cell
+            if compiled is None:
+                self.dependencies[dependencies] = [(self.cells[self.index[column]], mapping.id) for _, column, mapping in self.plan.dependencies(dependencies)]
+        else:
+            for cells, _id in compiled:
+                cell = cells[i]
+                if cell is not SKIPPED:
+                    values[_id] = cell
+        if data_type:
+            values.update(next(iter(data_type.values())))
+        values['bts:HTANParticipantID'] = participant_id
+        values['bts:HTANBiospecimenID'] = biospecimen_id
+        values['bts:HTANParentBiospecimenID'] = parent_biospecimen_id
+        return values
+
+    def others(self) -> list[bool] | None:
+        """Return whether each row has classes below bts:Thing other than the THING_CLASSES, see Row.things(). None if no row has."""
+        rendered = THING_CLASSES + ('bts:Filename', 'bts:FileFormat')
+        entries = [_ for _ in self.plan.top_level if _[2].path[1] not in rendered]
+        columns = [self.index[column] for _, column, _ in entries]
+        columns += self._candidates(lambda m: not m.in_assay and m.path[1] not in rendered)
+        if not columns:
+            return None
+        others = []
+        for i in range(self.size):
+            others.append(any(
+                mapping.path[1] not in rendered and self.cell(column, i) is not SKIPPED
+                for _, column, mapping in merged_entries(self.plan.top_level, self.content[i], prefix=('bts:Thing',))
+            ))
+        return others
+
+    def row(self, i) -> Row:
+        return Row(self.plan, {column: self.data[j][i] for j, column in enumerate(self.columns)}, self.assays[i], skip_empty=self.skip_empty)
+
+    def resources(self, emitted_already=None, report: RunReport = None):
+        """Yield the FHIR resources of the batch's rows, as model.fhir_resources() does for their Rows."""
+        size = self.size
+        participant_ids = self.values(PARTICIPANT_ID, self.participants)
+        biospecimen_participant_ids = self.values(BIOSPECIMEN_PARTICIPANT_ID, self.participants)
+        biospecimen_ids = self.values(BIOSPECIMEN_ID, SKIPPED)
+        parent_biospecimen_ids = self.values(PARENT_BIOSPECIMEN_ID, {})
+        file_ids = self.values(FILE_ID, {})
+        synapse_ids = self.values(SYNAPSE_ID, {})
+        data_accesses = self.values(DATA_ACCESS, {})
+        filenames = self.values(FILENAME, self.values(FILE_FILENAME, {}))
+        file_formats = self.values(FILE_FORMAT, self.values(FILE_FILE_FORMAT, {}))
+        centers = self.children(CENTER)
+        data_types = self.children(DATA_TYPE)
+        others = self.others()
+        # ids of the entities repeated across rows, once per distinct value
+        patient_ids = {_: [model._to_id(_), model._to_id(_ + '-HTA9')] for _ in set(participant_ids) if isinstance(_, str)}
+        specimen_ids = {_: [model._to_id(s) for s in _.split(',')] for _ in set(biospecimen_ids) if isinstance(_, str)}
+
+        def emitted(ids) -> bool:
+            return bool(ids) and emitted_already is not None and all(_ in emitted_already for _ in ids)
+
+        def skipped(k):
+            if report is not None:
+                report.count(f"things_emitted_already.{k}")
+
+        for i in range(size):
+            if others and others[i]:
+                # not rendered to FHIR, fhirized() reports them
+                yield from model.fhir_resources([self.row(i)], emitted_already, report)
+                continue
+            biospecimen_id = {} if biospecimen_ids[i] is SKIPPED else biospecimen_ids[i]
+            # bts:Assay
+            yield model._task(self.assays[i].assay_klass,
+                              self.assay_values(i, biospecimen_participant_ids[i], biospecimen_id, parent_biospecimen_ids[i], data_types[i]), 'bts_Assay')
+            # bts:IndividualOrganism
+            participant_id = participant_ids[i]
+            if emitted(patient_ids.get(participant_id, None)):
+                skipped('bts_IndividualOrganism')
+            else:
+                yield from model._patient(participant_id)
+            # bts:Biosample
+            if emitted(specimen_ids.get(biospecimen_ids[i], None)):
+                skipped('bts_Biosample')
+            else:
+                yield from model._specimens(biospecimen_id, biospecimen_participant_ids[i])
+            # bts:InformationContentEntity
+            yield model._document_reference(file_ids[i], synapse_ids[i], data_accesses[i], biospecimen_participant_ids[i],
+                                            filenames[i], file_formats[i])
+            # bts:Publication
+            center = centers[i]
+            center_id = next(iter(center.values())) if center else None
+            if isinstance(center_id, str) and emitted([model._to_id(center_id)]):
+                skipped('bts_Publication')
+            else:
+                yield from model._research_study(next(iter(center.values())))
+
+
+def columnar_resources(source, assay_resolver, emitted_already=None, skip_empty=True, sample_assays=False, batch_size=10000,
+                       report: RunReport = None):
+    """Yield the FHIR resources of a table, normalized a batch of columns at a time, see model.fhir_resources().
+    The output is the same as fhir_resources(normalize(source, flat=True), emitted_already)'s.
+    """
+    plans = {}
+    assay_types_seen_already = set()
+    for columns, data in read_batches(source, batch_size):
+        key = tuple(columns)
+        plan = plans.get(key, None)
+        if plan is None:
+            plan = plans[key] = ColumnPlan(assay_resolver.hs, columns)
+            if report is not None:
+                report.cache('column_plan', plan.get_by_content.cache_info)
+        if report is not None:
+            report.count('rows_read', len(data[0]))
+        if sample_assays:
+            assays = data[columns.index('Assay')]
+            keep = []
+            for i, assay in enumerate(assays):
+                if assay not in assay_types_seen_already:
+                    assay_types_seen_already.add(assay)
+                    keep.append(i)
+            if report is not None:
+                report.count('rows_skipped_sample_assays', len(assays) - len(keep))
+            data = [[column[i] for i in keep] for column in data]
+            if not keep:
+                continue
+        batch = ColumnBatch(plan, columns, data, assay_resolver, skip_empty=skip_empty)
+        if report is not None:
+            for j, column in enumerate(columns):
+                mapping = plan.columns.get(column, None)
+                if mapping is model.CONTENT_DEPENDENT:
+                    missing = sum(1 for c, m in zip(batch.cells[j], batch.mappings[column]) if c is not SKIPPED and not m)
+                elif not mapping:
+                    missing = sum(1 for c in batch.cells[j] if c is not SKIPPED)
+                else:
+                    continue
+                if missing:
+                    report.missing_mapping[column] += missing
+        yield from batch.resources(emitted_already, report)
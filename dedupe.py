@@ -0,0 +1,249 @@
+"""Stores of the FHIR ids emitted already, see model.main()."""
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+from array import array
+
+from ids import digest64
+
+
+class Dedupe:
+    """A set of ids: in, add() and len(), without statistics, see TimedDedupe.
+    Subclasses implement them and memory_bytes().
+    """
+    backend = None
+
+    def memory_bytes(self) -> int:
+        """Return the (approximate) memory used by the ids."""
+        raise NotImplementedError
+
+    def stats(self) -> dict:
+        return {
+            'backend': self.backend,
+            'ids': len(self),
+            'memory_bytes': self.memory_bytes(),
+        }
+
+    def close(self):
+        pass
+
+
+class SetDedupe(Dedupe, set):
+    """The ids in a python set, its in and add() as is."""
+    backend = 'memory'
+
+    def memory_bytes(self) -> int:
+        return sys.getsizeof(self) + sum(sys.getsizeof(_) for _ in self)
+
+
+class DigestDedupe(Dedupe):
+    """64 bit digests of the ids in an open addressing table of fixed width slots.
+    When exact, the ids are kept as utf-8 in a single bytearray to confirm a digest match,
+    otherwise a digest collision (p ~ n^2 / 2^65) would drop an id.
+    """
+    backend = 'digest'
+
+    def __init__(self, exact=True, capacity=1 << 16):
+        self.count = 0
+        self.exact = exact
+        size = 1
+        while size < capacity:
+            size <<= 1
+        self.slots = array('Q', [0]) * size
+        # slot -> position of the id in ends, for exact confirmation
+        self.refs = array('I', [0]) * size if exact else None
+        self.arena = bytearray()
+        self.ends = array('Q')
+
+    def _id_at(self, position) -> bytearray:
+        start = self.ends[position - 1] if position else 0
+        return self.arena[start:self.ends[position]]
+
+    def _find(self, key: bytes, digest: int) -> tuple[bool, int]:
+        """Return whether the key is in the table and its (or its free) slot."""
+        slots = self.slots
+        mask = len(slots) - 1
+        i = digest & mask
+        while True:
+            slot = slots[i]
+            if not slot:
+                return False, i
+            if slot == digest and (not self.exact or self._id_at(self.refs[i]) == key):
+                return True, i
+            i = (i + 1) & mask
+
+    def __len__(self):
+        return self.count
+
+    def __contains__(self, _id) -> bool:
+        key = _id.encode()
+        return self._find(key, digest64(key))[0]
+
+    def add(self, _id):
+        key = _id.encode()
+        digest = digest64(key)
+        found, i = self._find(key, digest)
+        if found:
+            return
+        self.slots[i] = digest
+        if self.exact:
+            self.refs[i] = len(self.ends)
+            self.arena += key
+            self.ends.append(len(self.arena))
+        self.count += 1
+        # keep the load factor under 2/3
+        if 3 * self.count > 2 * len(self.slots):
+            self._grow()
+
+    def _grow(self):
+        slots, refs = self.slots, self.refs
+        size = 2 * len(slots)
+        mask = size - 1
+        self.slots = array('Q', [0]) * size
+        self.refs = array('I', [0]) * size if self.exact else None
+        for j, digest in enumerate(slots):
+            if not digest:
+                continue
+            i = digest & mask
+            while self.slots[i]:
+                i = (i + 1) & mask
+            self.slots[i] = digest
+            if self.exact:
+                self.refs[i] = refs[j]
+
+    def memory_bytes(self) -> int:
+        size = self.slots.buffer_info()[1] * self.slots.itemsize
+        if self.exact:
+            size += self.refs.buffer_info()[1] * self.refs.itemsize
+            size += len(self.arena) + self.ends.buffer_info()[1] * self.ends.itemsize
+        return size
+
+
+class SqliteDedupe(Dedupe):
+    """The ids in an on disk SQLite table, for runs with more ids than fit in memory.
+    Without a path the database is a temporary file, removed on close(). The store starts empty, a database
+    at path is replaced: it holds a previous run's ids, or is corrupt if that run was killed (journal_mode is OFF).
+    Any other file at path raises a ValueError, it is not replaced.
+    """
+    backend = 'sqlite'
+
+    def __init__(self, path=None, cache_kib=65536):
+        self.count = 0
+        self.temporary = path is None
+        if self.temporary:
+            fd, path = tempfile.mkstemp(suffix='.sqlite', prefix='dedupe-')
+            os.close(fd)
+        else:
+            if os.path.exists(path) and not _is_store(path):
+                raise ValueError(f"{path} is not an SQLite dedupe database, not replacing it")
+            for _ in (path, path + "-journal"):
+                if os.path.exists(_):
+                    os.remove(_)
+        self.path = path
+        self.cache_kib = cache_kib
+        self.connection = sqlite3.connect(path)
+        self.connection.execute("PRAGMA journal_mode=OFF")
+        self.connection.execute("PRAGMA synchronous=OFF")
+        self.connection.execute(f"PRAGMA cache_size=-{cache_kib}")
+        self.connection.execute("CREATE TABLE seen (id TEXT PRIMARY KEY) WITHOUT ROWID")
+
+    def __len__(self):
+        return self.count
+
+    def __contains__(self, _id) -> bool:
+        return self.connection.execute("SELECT 1 FROM seen WHERE id = ?", (_id,)).fetchone() is not None
+
+    def add(self, _id):
+        self.count += self.connection.execute("INSERT OR IGNORE INTO seen (id) VALUES (?)", (_id,)).rowcount
+
+    def memory_bytes(self) -> int:
+        # bounded by the page cache, the ids live on disk
+        return min(self.cache_kib * 1024, self.disk_bytes())
+
+    def disk_bytes(self) -> int:
+        page_count = self.connection.execute("PRAGMA page_count").fetchone()[0]
+        page_size = self.connection.execute("PRAGMA page_size").fetchone()[0]
+        return page_count * page_size
+
+    def stats(self) -> dict:
+        stats = super().stats()
+        stats['disk_bytes'] = self.disk_bytes()
+        return stats
+
+    def close(self):
+        self.connection.commit()
+        self.connection.close()
+        if self.temporary:
+            os.remove(self.path)
+
+
+def _is_store(path) -> bool:
+    """Return whether a file is empty, or an SQLite database with a seen table, a SqliteDedupe's."""
+    if os.path.getsize(path) == 0:
+        return True
+    with open(path, "rb") as f:
+        if f.read(16) != b"SQLite format 3\x00":
+            return False
+    connection = sqlite3.connect(path)
+    try:
+        return connection.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'seen'").fetchone() is not None
+    except sqlite3.DatabaseError:
+        return False
+    finally:
+        connection.close()
+
+
+class TimedDedupe:
+    """A store with the lookup statistics and seconds of its in and add(), for --dedupe-stats and --report."""
+    def __init__(self, store: Dedupe):
+        self.store = store
+        self.lookups = 0
+        self.hits = 0
+        self.seconds = 0.0
+
+    def __contains__(self, _id) -> bool:
+        start = time.perf_counter()
+        found = _id in self.store
+        self.seconds += time.perf_counter() - start
+        self.lookups += 1
+        if found:
+            self.hits += 1
+        return found
+
+    def __len__(self):
+        return len(self.store)
+
+    def add(self, _id):
+        start = time.perf_counter()
+        self.store.add(_id)
+        self.seconds += time.perf_counter() - start
+
+    def stats(self) -> dict:
+        ids = len(self.store)
+        return {
+            **self.store.stats(),
+            'lookups': self.lookups,
+            'hits': self.hits,
+            'seconds': round(self.seconds, 6),
+            'operations_per_second': round((self.lookups + ids) / self.seconds) if self.seconds else None,
+        }
+
+    def close(self):
+        self.store.close()
+
+
+BACKENDS = {
+    SetDedupe.backend: SetDedupe,
+    DigestDedupe.backend: DigestDedupe,
+    SqliteDedupe.backend: SqliteDedupe,
+}
+
+
+def dedupe_store(backend='memory', timed=False, **kwargs) -> Dedupe | TimedDedupe:
+    """Return an empty store of the named backend, in a TimedDedupe when timed."""
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown dedupe backend {backend}, expected one of {', '.join(BACKENDS)}")
+    store = BACKENDS[backend](**kwargs)
+    return TimedDedupe(store) if timed else store
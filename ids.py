@@ -0,0 +1,12 @@
+"""The FHIR ids of HTAN identifiers, and the 64 bit digests of keys, shared by model.py, dedupe.py and lookup.py."""
+import hashlib
+
+
+def to_id(_id: str) -> str:
+    """Convert a string to a valid FHIR id."""
+    return _id.replace(":", "_").replace(" ", "").replace("_", "-").replace(",", "-")
+
+
+def digest64(key: bytes) -> int:
+    """Return the 64 bit digest of a key, never 0, which marks an empty slot of the open addressing tables."""
+    return int.from_bytes(hashlib.blake2b(key, digest_size=8).digest(), 'little') or 1
@@ -0,0 +1,82 @@
+"""Referential integrity of the resources of a run, checked as they are emitted, see model.main()."""
+import collections
+import sys
+
+
+# elements (CodeableConcept, Coding, Meta, Narrative) without references, not walked
+NO_REFERENCES = frozenset(['code', 'coding', 'type', 'meta', 'text'])
+
+
+def references(resource) -> list[str]:
+    """Return the reference strings of a resource, at any depth."""
+    found = []
+    stack = [resource]
+    while stack:
+        value = stack.pop()
+        if type(value) is dict:
+            for k, v in value.items():
+                if k == 'reference':
+                    if type(v) is str:
+                        found.append(v)
+                elif k not in NO_REFERENCES and (type(v) is dict or type(v) is list):
+                    stack.append(v)
+        else:
+            for v in value:
+                if type(v) is dict or type(v) is list:
+                    stack.append(v)
+    return found
+
+
+class ReferenceIndex:
+    """The emitted resources (as the 64 bit hash() of their Type/id) and the references between them.
+    A reference to a resource emitted already is resolved on the spot, the others are kept until their
+    resource is emitted, what is left at the end of the run is dangling.
+    Contained (#id) and absolute (with a scheme) references are counted as external, not checked.
+    A hash collision (p ~ n^2 / 2^65) could hide a dangling reference, the index only lives for the run's process.
+    """
+    def __init__(self, examples=20):
+        self.emitted = set()
+        self.examples = examples
+        self.resources = collections.Counter()
+        # per referenced resourceType
+        self.referenced = collections.Counter()
+        self.external = 0
+        # reference -> [count, first resource referring to it]
+        self.pending = {}
+
+    def add(self, resource_type, _id, references):
+        """Add an emitted resource and the references it makes."""
+        key = f"{resource_type}/{_id}"
+        self.emitted.add(hash(key))
+        self.resources[resource_type] += 1
+        self.pending.pop(key, None)
+        for reference in references:
+            if reference.startswith('#') or ':' in reference:
+                self.external += 1
+                continue
+            self.referenced[reference.split('/', 1)[0]] += 1
+            pending = self.pending.get(reference, None)
+            if pending is not None:
+                pending[0] += 1
+            elif hash(reference) not in self.emitted:
+                self.pending[reference] = [1, key]
+
+    def summary(self) -> dict:
+        dangling = collections.Counter()
+        for reference, (count, _) in self.pending.items():
+            dangling[reference.split('/', 1)[0]] += count
+        types = sorted(set(self.resources) | set(self.referenced))
+        return {
+            'resources': {
+                _: {'emitted': self.resources[_], 'referenced': self.referenced[_], 'dangling': dangling[_]} for _ in types
+            },
+            'references': sum(self.referenced.values()),
+            'external_references': self.external,
+            'dangling_references': sum(dangling.values()),
+            'dangling_targets': len(self.pending),
+            'dangling': [
+                {'reference': reference, 'count': count, 'from': referrer}
+                for reference, (count, referrer) in sorted(self.pending.items(), key=lambda _: -_[1][0])[:self.examples]
+            ],
+            'memory_bytes': sys.getsizeof(self.emitted) + sum(sys.getsizeof(_) for _ in self.emitted),
+        }
@@ -0,0 +1,384 @@
+"""Loads the ndjson output of model.py into a FHIR server as transaction Bundles.
+
+    python loader.py load --input META --url http://localhost:8080/fhir --concurrency 8
+    python loader.py stub --port 8080  # a stand-in FHIR endpoint, to try the loader against
+"""
+import asyncio
+import concurrent.futures
+import glob
+import gzip
+import hashlib
+import http.client
+import http.server
+import io
+import json
+import os
+import queue
+import random
+import sys
+import threading
+import time
+import urllib.parse
+
+import click
+
+from writer import MANIFEST
+
+# tiers of resourceTypes, a tier's resources only reference those of the tiers before it
+LOAD_ORDER = [
+    ('ResearchStudy', 'Patient'),
+    ('ResearchSubject', 'Specimen'),
+    ('DocumentReference',),
+    ('Task',),
+]
+
+RETRY_STATUS = frozenset([408, 429, 500, 502, 503, 504])
+
+
+def ndjson_files(input_path) -> dict[str, list[str]]:
+    """Return the ndjson files of a directory by resourceType, see writer.NdjsonWriter.
+    The files of a sharded or compressed output are those its MANIFEST lists, checked against their counts and sha256,
+    otherwise the plain {resourceType}.ndjson files.
+    """
+    files = {}
+    manifest_path = os.path.join(input_path, MANIFEST)
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            entries = json.load(f)['files']
+        for entry in entries:
+            path = os.path.join(input_path, entry['file'])
+            _verify(path, entry)
+            files.setdefault(entry['resourceType'], []).append(path)
+        return files
+    for path in sorted(glob.glob(os.path.join(input_path, "*.ndjson"))):
+        resource_type = os.path.basename(path)[:-len(".ndjson")]
+        if '.' not in resource_type:
+            files[resource_type] = [path]
+    return files
+
+
+def _verify(path, entry: dict):
+    """Raise a ValueError if a file doesn't have the bytes, sha256 and count of lines of its MANIFEST entry."""
+    if not os.path.exists(path):
+        raise ValueError(f"{path} is listed in {MANIFEST} but missing")
+    sha256 = hashlib.sha256()
+    size = 0
+    with open(path, "rb") as f:
+        while True:
+            data = f.read(1 << 20)
+            if not data:
+                break
+            sha256.update(data)
+            size += len(data)
+    if size != entry['bytes'] or sha256.hexdigest() != entry['sha256']:
+        raise ValueError(f"{path} doesn't match its {MANIFEST} entry: {size} bytes, expected {entry['bytes']}, or a different sha256")
+    with _open(path) as f:
+        count = sum(1 for _ in f)
+    if count != entry['count']:
+        raise ValueError(f"{path} has {count} lines, {MANIFEST} lists {entry['count']}")
+
+
+def _open(path):
+    if path.endswith('.gz'):
+        return gzip.open(path, mode='rt')
+    if path.endswith('.zst'):
+        import zstandard
+        return io.TextIOWrapper(zstandard.ZstdDecompressor().stream_reader(open(path, 'rb'), closefd=True))
+    return open(path, mode='r')
+
+
+def read_lines(paths):
+    """Yield the non empty lines of ndjson files."""
+    for path in paths:
+        with _open(path) as f:
+            for line in f:
+                line = line.strip()
+                if line:
+                    yield line
+
+
+def tiers(files: dict[str, list[str]]) -> list[list[str]]:
+    """Return the resourceTypes of the files in LOAD_ORDER, unknown ones in a last tier."""
+    ordered = [[_ for _ in tier if _ in files] for tier in LOAD_ORDER]
+    known = {_ for tier in LOAD_ORDER for _ in tier}
+    ordered.append(sorted(_ for _ in files if _ not in known))
+    return [_ for _ in ordered if _]
+
+
+def bundles(lines, bundle_size) -> tuple[bytes, dict]:
+    """Yield transaction Bundles of bundle_size resources, and their count per resourceType.
+    The resources are PUT to their id, so a retried Bundle is idempotent. Their ndjson lines are
+    copied into the body as is, only the resourceType and id are read from them.
+    """
+    entries = []
+    counts = {}
+    for line in lines:
+        resource = json.loads(line)
+        url = f"{resource['resourceType']}/{resource['id']}"
+        entries.append(f'{{"fullUrl":{json.dumps(url)},"resource":{line},"request":{{"method":"PUT","url":{json.dumps(url)}}}}}')
+        counts[resource['resourceType']] = counts.get(resource['resourceType'], 0) + 1
+        if len(entries) == bundle_size:
+            yield _bundle(entries), counts
+            entries = []
+            counts = {}
+    if entries:
+        yield _bundle(entries), counts
+
+
+def _bundle(entries) -> bytes:
+    return ('{"resourceType":"Bundle","type":"transaction","entry":[' + ','.join(entries) + ']}').encode()
+
+
+class ConnectionPool:
+    """Keep-alive http.client connections to a FHIR server, one per concurrent request."""
+    def __init__(self, url, timeout=60, headers=None):
+        parsed = urllib.parse.urlsplit(url)
+        self.connection_class = http.client.HTTPSConnection if parsed.scheme == 'https' else http.client.HTTPConnection
+        self.host = parsed.netloc
+        self.path = parsed.path.rstrip('/') or '/'
+        self.timeout = timeout
+        self.headers = {'Content-Type': 'application/fhir+json', 'Accept': 'application/fhir+json', **(headers or {})}
+        self.idle = queue.LifoQueue()
+
+    def _connection(self) -> http.client.HTTPConnection:
+        try:
+            return self.idle.get_nowait()
+        except queue.Empty:
+            return self.connection_class(self.host, timeout=self.timeout)
+
+    def post(self, body: bytes) -> tuple[int, dict, bytes]:
+        """POST a body to the server's base url, return the status, headers and body of the response."""
+        connection = self._connection()
+        try:
+            connection.request('POST', self.path, body=body, headers=self.headers)
+            response = connection.getresponse()
+            data = response.read()
+        except (OSError, http.client.HTTPException):
+            connection.close()
+            raise
+        if response.will_close:
+            connection.close()
+        else:
+            self.idle.put(connection)
+        return response.status, dict(response.getheaders()), data
+
+    def close(self):
+        while not self.idle.empty():
+            self.idle.get_nowait().close()
+
+
+class Loader:
+    """Sends the Bundles of an ndjson directory, tier by tier in LOAD_ORDER, at most concurrency at a time.
+    Connection errors and the RETRY_STATUS responses are retried up to retries times, with exponential backoff.
+    """
+    def __init__(self, url, bundle_size=500, concurrency=8, retries=5, backoff=0.5, timeout=60, headers=None, log=None):
+        self.pool = ConnectionPool(url, timeout=timeout, headers=headers)
+        self.bundle_size = bundle_size
+        self.concurrency = concurrency
+        self.retries = retries
+        self.backoff = backoff
+        self.log = log or (lambda msg: print(msg, file=sys.stderr))
+        self.loaded = {}
+        self.failed = {}
+        self.bundles = 0
+        self.failed_bundles = 0
+        self.retried = 0
+        self.bytes = 0
+        self.latencies = []
+
+    async def _send(self, executor, body: bytes, counts: dict):
+        loop = asyncio.get_running_loop()
+        for attempt in range(self.retries + 1):
+            start = time.perf_counter()
+            retry_after = None
+            try:
+                status, headers, data = await loop.run_in_executor(executor, self.pool.post, body)
+                error = None if 200 <= status < 300 else f"HTTP {status} {data[:200]!r}"
+                retry_after = headers.get('Retry-After', None)
+            except (OSError, http.client.HTTPException) as e:
+                status, error = None, f"{type(e).__name__} {e}"
+            self.latencies.append(time.perf_counter() - start)
+            if not error:
+                self.bundles += 1
+                self.bytes += len(body)
+                for k, v in counts.items():
+                    self.loaded[k] = self.loaded.get(k, 0) + v
+                return
+            if attempt == self.retries or (status is not None and status not in RETRY_STATUS):
+                break
+            self.retried += 1
+            delay = float(retry_after) if retry_after and retry_after.isdigit() else self.backoff * (2 ** attempt)
+            await asyncio.sleep(delay * random.uniform(0.5, 1.5))
+        self.failed_bundles += 1
+        for k, v in counts.items():
+            self.failed[k] = self.failed.get(k, 0) + v
+        self.log(f"Bundle of {counts} failed: {error}")
+
+    async def _send_all(self, executor, bundles_):
+        """Send the Bundles, reading the next one only when a request slot is free."""
+        slots = asyncio.Semaphore(self.concurrency)
+        pending = set()
+        for body, counts in bundles_:
+            await slots.acquire()
+            task = asyncio.create_task(self._send(executor, body, counts))
+            task.add_done_callback(lambda _: slots.release())
+            pending.add(task)
+            task.add_done_callback(pending.discard)
+        if pending:
+            await asyncio.gather(*pending)
+
+    async def load(self, input_path) -> dict:
+        """Load the ndjson files of a directory, return the throughput report."""
+        files = ndjson_files(input_path)
+        start = time.perf_counter()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            for tier in tiers(files):
+                tier_start = time.perf_counter()
+                lines = (line for resource_type in tier for line in read_lines(files[resource_type]))
+                await self._send_all(executor, bundles(lines, self.bundle_size))
+                self.log(f"Loaded {', '.join(tier)} in {time.perf_counter() - tier_start:.1f}s")
+        self.pool.close()
+        return self.report(time.perf_counter() - start)
+
+    def report(self, seconds) -> dict:
+        latencies = sorted(self.latencies)
+
+        def percentile(p):
+            return round(latencies[min(len(latencies) - 1, int(p * len(latencies)))], 4) if latencies else None
+
+        loaded = sum(self.loaded.values())
+        return {
+            'seconds': round(seconds, 3),
+            'resources': loaded,
+            'resources_per_second': round(loaded / seconds) if seconds else None,
+            'bundles': self.bundles,
+            'failed_bundles': self.failed_bundles,
+            'retried': self.retried,
+            'megabytes_per_second': round(self.bytes / seconds / 1e6, 3) if seconds else None,
+            'latency_seconds': {'p50': percentile(0.5), 'p95': percentile(0.95), 'max': percentile(1.0)},
+            'loaded': dict(sorted(self.loaded.items())),
+            'failed': dict(sorted(self.failed.items())),
+        }
+
+
+class StubFhirServer(http.server.ThreadingHTTPServer):
+    """A stand-in FHIR endpoint, that keeps the resources of the transaction Bundles POSTed to it in memory.
+    A Bundle referencing a resource it has not received is rejected (HTTP 400), as a server enforcing
+    referential integrity would. failure_rate of the requests get a 503, and each takes latency seconds.
+    """
+    daemon_threads = True
+
+    def __init__(self, address, failure_rate=0.0, latency=0.0):
+        super().__init__(address, _StubHandler)
+        self.failure_rate = failure_rate
+        self.latency = latency
+        self.resources = {}
+        self.lock = threading.Lock()
+        self.requests = 0
+
+    @property
+    def url(self):
+        return f"http://{self.server_address[0]}:{self.server_address[1]}/fhir"
+
+
+def _references(value) -> list[str]:
+    if isinstance(value, dict):
+        return [_ for k, v in value.items() for _ in ([v] if k == 'reference' and isinstance(v, str) else _references(v))]
+    if isinstance(value, list):
+        return [_ for v in value for _ in _references(v)]
+    return []
+
+
+class _StubHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _respond(self, status, body: dict):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/fhir+json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _outcome(self, status, diagnostics):
+        self._respond(status, {'resourceType': 'OperationOutcome', 'issue': [{'severity': 'error', 'code': 'processing', 'diagnostics': diagnostics}]})
+
+    def do_POST(self):
+        server: StubFhirServer = self.server
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        with server.lock:
+            server.requests += 1
+        if server.latency:
+            time.sleep(server.latency)
+        if random.random() < server.failure_rate:
+            return self._outcome(503, "injected failure")
+        try:
+            bundle = json.loads(body)
+        except ValueError as e:
+            return self._outcome(400, f"invalid json {e}")
+        if bundle.get('resourceType') != 'Bundle' or bundle.get('type') != 'transaction':
+            return self._outcome(400, "expected a transaction Bundle")
+        entries = bundle.get('entry', [])
+        urls = {_['request']['url'] for _ in entries}
+        with server.lock:
+            for entry in entries:
+                for reference in _references(entry['resource']):
+                    if reference not in server.resources and reference not in urls:
+                        return self._outcome(400, f"{entry['request']['url']} references {reference}, not found")
+            for entry in entries:
+                server.resources[entry['request']['url']] = entry['resource']
+        self._respond(200, {'resourceType': 'Bundle', 'type': 'transaction-response',
+                            'entry': [{'response': {'status': '200 OK', 'location': _['request']['url']}} for _ in entries]})
+
+
+@click.group()
+def cli():
+    """Load FHIR ndjson into a FHIR server."""
+
+
+@cli.command()
+@click.option('--input', 'input_path', default="META", show_default=True, help="Directory of the ndjson files, plain, sharded or compressed.")
+@click.option('--url', required=True, help="Base url of the FHIR server, Bundles are POSTed to it.")
+@click.option('--bundle-size', default=500, show_default=True, type=click.IntRange(min=1), help="Resources per transaction Bundle.")
+@click.option('--concurrency', default=8, show_default=True, type=click.IntRange(min=1), help="Bundles in flight.")
+@click.option('--retries', default=5, show_default=True, type=click.IntRange(min=0), help="Retries of a Bundle on connection errors, 408, 429 and 5xx.")
+@click.option('--backoff', default=0.5, show_default=True, help="Seconds before the first retry, doubled for each next one.")
+@click.option('--timeout', default=60, show_default=True, help="Seconds before a request times out.")
+@click.option('--header', 'headers', multiple=True, help="Header of the requests, e.g. 'Authorization: Bearer ...'.")
+@click.option('--report', 'report_path', default=None, help="Write the throughput report to this json file, printed otherwise.")
+def load(input_path, url, bundle_size, concurrency, retries, backoff, timeout, headers, report_path):
+    """Load the ndjson files of a directory, tier by tier in LOAD_ORDER."""
+    headers = dict(_.split(':', 1) for _ in headers)
+    headers = {k.strip(): v.strip() for k, v in headers.items()}
+    loader = Loader(url, bundle_size=bundle_size, concurrency=concurrency, retries=retries, backoff=backoff, timeout=timeout, headers=headers)
+    report = asyncio.run(loader.load(input_path))
+    if report_path:
+        with open(report_path, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        click.echo(json.dumps(report, indent=2))
+    if report['failed_bundles']:
+        sys.exit(1)
+
+
+@cli.command()
+@click.option('--host', default="127.0.0.1", show_default=True)
+@click.option('--port', default=8080, show_default=True)
+@click.option('--failure-rate', default=0.0, show_default=True, help="Fraction of the requests answered with a 503.")
+@click.option('--latency', default=0.0, show_default=True, help="Seconds added to each request.")
+def stub(host, port, failure_rate, latency):
+    """Run a stand-in FHIR endpoint that checks the references of the Bundles."""
+    server = StubFhirServer((host, port), failure_rate=failure_rate, latency=latency)
+    click.echo(f"Listening on {server.url}", err=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    click.echo(f"{server.requests} requests, {len(server.resources)} resources", err=True)
+
+
+if __name__ == '__main__':
+    cli()
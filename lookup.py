@@ -0,0 +1,220 @@
+"""A byte offset index of the ndjson output of model.py, and lookups of resources through it.
+
+    python model.py --index  # writes META/ndjson.index next to the ndjson files
+    python lookup.py get --input META Patient/HTA9-12
+    python lookup.py patient --input META HTA9_12 > HTA9_12.ndjson  # every resource linked to a participant
+
+The index is an open addressing hash table of 64 bit key digests, read through mmap, so a lookup
+reads a slot or two and the lines it points at, whatever the size of the output.
+Keys are the Type/id of each resource, and patient:{id} and specimen:{id} for the resources referencing them.
+"""
+import json
+import mmap
+import os
+import struct
+import sys
+
+import click
+
+from ids import digest64, to_id
+
+INDEX = "ndjson.index"
+
+MAGIC = b"NDJSONIX"
+VERSION = 1
+# magic, version, slot count, key count, offset of the records, offset of the file names
+HEADER = struct.Struct('<8sIQQQQ')
+# key digest (0 for an empty slot), offset of the key's record
+SLOT = struct.Struct('<QQ')
+# key length, entry count
+RECORD = struct.Struct('<HI')
+# file number, byte offset, length of a line
+ENTRY = struct.Struct('<IQI')
+
+
+def secondary_keys(resource_type, _id, references) -> list[str]:
+    """Return the patient:{id} and specimen:{id} keys of a resource, itself or the Patients and Specimens it references."""
+    keys = []
+    if resource_type == 'Patient':
+        keys.append(f"patient:{_id}")
+    elif resource_type == 'Specimen':
+        keys.append(f"specimen:{_id}")
+    for reference in references:
+        if reference.startswith('Patient/'):
+            keys.append(f"patient:{reference[8:]}")
+        elif reference.startswith('Specimen/'):
+            keys.append(f"specimen:{reference[9:]}")
+    return keys
+
+
+class IndexWriter:
+    """Collects the positions of the lines written by a writer.NdjsonWriter(positions=True), and writes INDEX on close()."""
+    def __init__(self, output_path):
+        self.path = os.path.join(output_path, INDEX)
+        self.files = {}
+        # key -> entry, or list of entries of a secondary key
+        self.keys = {}
+
+    def add(self, resource_type, _id, position, references=()):
+        """Add a resource's line, position is what NdjsonWriter.write() returned."""
+        file, offset, length = position
+        file_number = self.files.get(file, None)
+        if file_number is None:
+            file_number = self.files[file] = len(self.files)
+        entry = (file_number, offset, length)
+        self.keys[f"{resource_type}/{_id}"] = entry
+        for key in dict.fromkeys(secondary_keys(resource_type, _id, references)):
+            entries = self.keys.get(key, None)
+            if entries is None:
+                self.keys[key] = [entry]
+            else:
+                entries.append(entry)
+
+    def close(self):
+        size = 1
+        # keep the load factor under 1/2
+        while size < 2 * len(self.keys):
+            size <<= 1
+        mask = size - 1
+        slots = [(0, 0)] * size
+        records = bytearray()
+        records_start = HEADER.size + size * SLOT.size
+        for key, entries in self.keys.items():
+            if isinstance(entries, tuple):
+                entries = [entries]
+            key = key.encode()
+            digest = digest64(key)
+            i = digest & mask
+            while slots[i][0]:
+                i = (i + 1) & mask
+            slots[i] = (digest, records_start + len(records))
+            records += RECORD.pack(len(key), len(entries))
+            records += key
+            for entry in entries:
+                records += ENTRY.pack(*entry)
+        files = json.dumps(list(self.files)).encode()
+        with open(self.path + ".tmp", "wb") as f:
+            f.write(HEADER.pack(MAGIC, VERSION, size, len(self.keys), records_start, records_start + len(records)))
+            f.write(b''.join(SLOT.pack(*_) for _ in slots))
+            f.write(records)
+            f.write(files)
+        os.replace(self.path + ".tmp", self.path)
+        self.keys = {}
+
+
+class ResourceIndex:
+    """Lookups of resources in an output directory through its INDEX, the index and ndjson files are mmap'ed."""
+    def __init__(self, output_path):
+        self.output_path = output_path
+        with open(os.path.join(output_path, INDEX), "rb") as f:
+            self.index = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self.size, self.count, self.records_start, files_start = HEADER.unpack_from(self.index, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f"{os.path.join(output_path, INDEX)} is not a version {VERSION} index")
+        self.files = json.loads(self.index[files_start:])
+        self.maps = {}
+
+    def __len__(self):
+        return self.count
+
+    def _entries(self, key: str) -> list[tuple[int, int, int]]:
+        key = key.encode()
+        digest = digest64(key)
+        mask = self.size - 1
+        i = digest & mask
+        while True:
+            slot, record = SLOT.unpack_from(self.index, HEADER.size + i * SLOT.size)
+            if not slot:
+                return []
+            if slot == digest:
+                length, count = RECORD.unpack_from(self.index, record)
+                start = record + RECORD.size
+                if self.index[start:start + length] == key:
+                    start += length
+                    return [ENTRY.unpack_from(self.index, start + j * ENTRY.size) for j in range(count)]
+            i = (i + 1) & mask
+
+    def _map(self, file_number) -> mmap.mmap:
+        data = self.maps.get(file_number, None)
+        if data is None:
+            with open(os.path.join(self.output_path, self.files[file_number]), "rb") as f:
+                data = self.maps[file_number] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return data
+
+    def lines(self, key: str) -> list[bytes]:
+        """Return the ndjson lines of a key: a Type/id, patient:{id} or specimen:{id}."""
+        return [self._map(file_number)[offset:offset + length] for file_number, offset, length in self._entries(key)]
+
+    def get(self, reference) -> dict | None:
+        """Return the resource of a Type/id, None if it is not in the output."""
+        lines = self.lines(reference)
+        return json.loads(lines[0]) if lines else None
+
+    def patient(self, _id) -> list[dict]:
+        """Return the Patient of a (FHIR) id and the resources referencing it."""
+        return [json.loads(_) for _ in self.lines(f"patient:{_id}")]
+
+    def specimen(self, _id) -> list[dict]:
+        """Return the Specimen of a (FHIR) id and the resources referencing it."""
+        return [json.loads(_) for _ in self.lines(f"specimen:{_id}")]
+
+    def close(self):
+        for data in self.maps.values():
+            data.close()
+        self.maps = {}
+        self.index.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def _echo(lines):
+    out = sys.stdout.buffer
+    for line in lines:
+        out.write(line)
+        out.write(b'\n')
+    out.flush()
+
+
+@click.group()
+def cli():
+    """Look resources up in the ndjson output of model.py through its index."""
+
+
+@cli.command()
+@click.option('--input', 'input_path', default="META", show_default=True, help="Output directory of model.py --index.")
+@click.argument('references', nargs=-1, required=True)
+def get(input_path, references):
+    """Print the ndjson lines of resources by Type/id."""
+    with ResourceIndex(input_path) as index:
+        lines = {_: index.lines(_) for _ in references}
+        _echo(line for _ in lines.values() for line in _)
+    missing = [_ for _, found in lines.items() if not found]
+    if missing:
+        click.echo(f"Not found: {' '.join(missing)}", err=True)
+        sys.exit(1)
+
+
+@cli.command()
+@click.option('--input', 'input_path', default="META", show_default=True, help="Output directory of model.py --index.")
+@click.argument('participant_id')
+def patient(input_path, participant_id):
+    """Print the Patient of a participant (HTAN or FHIR id) and every resource referencing it."""
+    with ResourceIndex(input_path) as index:
+        _echo(index.lines(f"patient:{to_id(participant_id)}"))
+
+
+@cli.command()
+@click.option('--input', 'input_path', default="META", show_default=True, help="Output directory of model.py --index.")
+@click.argument('biospecimen_id')
+def specimen(input_path, biospecimen_id):
+    """Print the Specimen of a biospecimen (HTAN or FHIR id) and every resource referencing it."""
+    with ResourceIndex(input_path) as index:
+        _echo(index.lines(f"specimen:{to_id(biospecimen_id)}"))
+
+
+if __name__ == '__main__':
+    cli()
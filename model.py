@@ -1,17 +1,68 @@
+import collections
+import contextlib
+import cProfile
 import csv
+import functools
+import gzip
 import hashlib
+import itertools
 import json
+import multiprocessing
+import os
+import pickle
 import sys
 from collections import defaultdict
-from typing import Generator
+from typing import Generator, Iterator, NamedTuple
+
+import click
+
+from checkpoint import Checkpoint
+from dedupe import dedupe_store
+from ids import to_id as _to_id
+from integrity import ReferenceIndex, references
+from lookup import IndexWriter
+from report import Profiles, RunReport, profile_stats, profiled
+from writer import NdjsonWriter, StreamWriter, encoder
+
+if __name__ == '__main__':
+    # run as a script: the modules importing model (columnar.py) get this one, rather than executing model.py again
+    sys.modules.setdefault('model', sys.modules[__name__])
+
+
+# bump when the layout of the compiled schema changes
+COMPILED_SCHEMA_VERSION = 1
 
 
 class HTANSchema:
-    """ A class to represent the HTAN schema """
-    def __init__(self, schema_file):
+    """ A class to represent the HTAN schema
+    The patched graph and its indexes are compiled once per JSON-LD file and cached
+    next to it (or in cache_dir), keyed by the sha256 of the file's content.
+    """
+    def __init__(self, schema_file, cache_dir=None, use_cache=True):
         # Load JSON-LD data from a file
-        with open(schema_file, "r") as f:
-            self.model = json.load(f)
+        with open(schema_file, "rb") as f:
+            content = f.read()
+        self.digest = hashlib.sha256(content).hexdigest()
+        cache_path = None
+        if use_cache:
+            cache_path = self.cache_path(schema_file, self.digest, cache_dir)
+            if self._load_compiled(cache_path):
+                return
+        self.model = json.loads(content)
+        self._patch()
+        self._compile()
+        if cache_path:
+            self._save_compiled(cache_path)
+
+    @staticmethod
+    def cache_path(schema_file, digest, cache_dir=None) -> str:
+        """Return the path of the compiled schema for a JSON-LD file."""
+        cache_dir = cache_dir or os.path.dirname(os.path.abspath(schema_file))
+        name = os.path.basename(schema_file)
+        return os.path.join(cache_dir, f".{name}.{digest[:16]}.v{COMPILED_SCHEMA_VERSION}.pickle")
+
+    def _patch(self):
+        """Add missing nodes and fix known issues in the graph."""
         # add missing nodes
         # thing was missing
         self.model['@graph'].append({
@@ -55,6 +106,8 @@ class HTANSchema:
                 _['@id'] = 'bts:ImagingLevel3'
                 _['rdfs:label'] = 'ImagingLevel3'
 
+    def _compile(self):
+        """Build the lookup tables."""
         # Create a dictionary of the model by @id
         self.model_by_id = {_['@id']: _ for _ in self.model['@graph']}
         # Create a dictionary of the model by sms:displayName
@@ -69,23 +122,72 @@ class HTANSchema:
             for rd in _.get('sms:requiresDependency', []):
                 self.model_by_dependency_of[rd['@id']][_['@id']] = _
 
+        # intern the classes, a class id is the position of the node in self.nodes
+        self.nodes = list(self.model_by_id.values())
+        self.index = {_['@id']: i for i, _ in enumerate(self.nodes)}
+        position = {id(_): i for i, _ in enumerate(self.nodes)}
+        for _ in self.model_by_display_name.values():
+            if id(_) not in position:
+                position[id(_)] = len(self.nodes)
+                self.nodes.append(_)
+
+        # a single table for the display name fallbacks, lowest priority first so higher ones win
+        self.lookup = {}
+        for _id, i in self.index.items():
+            if _id.startswith('bts:'):
+                self.lookup[_id[len('bts:'):]] = i
+        for display_name, _ in self.model_by_display_name.items():
+            if display_name.startswith('HTAN '):
+                self.lookup[display_name[len('HTAN '):]] = position[id(_)]
+        for display_name, _ in self.model_by_display_name.items():
+            self.lookup[display_name] = position[id(_)]
+
+        # the rdfs:subClassOf closure of every class, root first
+        self.lineage = []
+        for _ in self.nodes:
+            lineage = []
+            node = _
+            while node and id(node) not in lineage:
+                lineage.append(id(node))
+                if node['rdfs:subClassOf']:
+                    node = self.get_by_id(node['rdfs:subClassOf'][0]['@id'])
+                else:
+                    node = None
+            lineage.reverse()
+            self.lineage.append(tuple(position[_] for _ in lineage))
+
+    def _load_compiled(self, cache_path) -> bool:
+        """Restore a compiled schema, return False if there is none."""
+        try:
+            with open(cache_path, "rb") as f:
+                compiled = pickle.load(f)
+        except (OSError, pickle.UnpicklingError, EOFError):
+            return False
+        if compiled.get('digest') != self.digest:
+            return False
+        self.__dict__.update(compiled)
+        return True
+
+    def _save_compiled(self, cache_path):
+        """Write the compiled schema, a read only cache_dir is not an error."""
+        tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_path, "wb") as f:
+                pickle.dump(self.__dict__, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, cache_path)
+        except OSError as e:
+            print(f"Could not write compiled schema {cache_path}: {e}", file=sys.stderr)
+
     def get_by_id(self, _id):
         return self.model_by_id.get(_id, None)
 
     def get_by_display_name(self, display_name):
         if not display_name:
             return None
-        node = None
-        if not node:
-            node = self.model_by_display_name.get(display_name, None)
-        if not node:
-            node = self.model_by_display_name.get('HTAN ' + display_name, None)
-        if not node:
-            node = self.model_by_id.get('bts:' + display_name, None)
-        if not node:
-            node = self.model_by_id.get('bts:' + display_name.replace(' ', ''), None)
-
-        return node
+        i = self.lookup.get(display_name, None)
+        if i is None and ' ' in display_name:
+            i = self.index.get('bts:' + display_name.replace(' ', ''), None)
+        return None if i is None else self.nodes[i]
 
     def get_by_sub_class(self, sub_class) -> dict:
         return self.model_by_sub_class[sub_class]
@@ -96,8 +198,8 @@ class HTANSchema:
     def get_by_content(self, content) -> dict:
         if not content:
             return None
-        node = self.model_by_id.get('bts:' + content.replace(' ', ''), None)
-        return node
+        i = self.index.get('bts:' + content.replace(' ', ''), None)
+        return None if i is None else self.nodes[i]
 
     def get_column(self, display_name, content) -> dict:
         node = self.get_by_display_name(display_name)
@@ -105,152 +207,532 @@ class HTANSchema:
             node = self.get_by_content(content)
         return node
 
+    def get_path(self, node) -> list[str]:
+        """Return the @ids from the root class down to node, following the first rdfs:subClassOf."""
+        i = self.index.get(node['@id'], None)
+        if i is not None and self.nodes[i] is node:
+            return [self.nodes[_]['@id'] for _ in self.lineage[i]]
+        path = []
+        while node:
+            path.append(node['@id'])
+            if node['rdfs:subClassOf']:
+                node = self.get_by_id(node['rdfs:subClassOf'][0]['@id'])
+            else:
+                node = None
+        path.reverse()
+        return path
+
+
+class ColumnMapping(NamedTuple):
+    """A table column resolved to a schema node."""
+    id: str
+    parents: tuple[str, ...]
+    leaf: str
+    in_assay: bool
+    path: tuple[str, ...]
+
+
+# the paths of classes the FHIR resources are rendered from
+PATIENT = ('bts:Thing', 'bts:IndividualOrganism', 'bts:Patient')
+BIOSPECIMEN = ('bts:Thing', 'bts:Biosample', 'bts:Biospecimen')
+FILE = ('bts:Thing', 'bts:InformationContentEntity', 'bts:File')
+CENTER = ('bts:Thing', 'bts:Publication', 'bts:HTANCenterID')
+DATA_TYPE = ('bts:Thing', 'bts:Publication', 'bts:DataType')
+# the classes below bts:Thing every normalized row has
+THING_CLASSES = ('bts:Assay', 'bts:IndividualOrganism', 'bts:Biosample', 'bts:InformationContentEntity', 'bts:Publication')
+
+# the values every Row keeps in slots
+ROW_SLOTS = (
+    PATIENT + ('bts:HTANParticipantID',),
+    BIOSPECIMEN + ('bts:HTANParticipantID',),
+    BIOSPECIMEN + ('bts:HTANBiospecimenID',),
+    BIOSPECIMEN + ('bts:HTANParentBiospecimenID',),
+    FILE + ('bts:HTANDataFileID',),
+    FILE + ('bts:SynapseID',),
+    FILE + ('bts:DataAccess',),
+    FILE + ('bts:Filename',),
+    FILE + ('bts:FileFormat',),
+    ('bts:Thing', 'bts:Filename'),
+    ('bts:Thing', 'bts:FileFormat'),
+)
+SLOT = {path: i for i, path in enumerate(ROW_SLOTS)}
+
+
+# marker for columns whose node can only be resolved from the cell content
+CONTENT_DEPENDENT = object()
+
+
+class ColumnPlan:
+    """The schema mapping of a table's columns, compiled once from the header.
+    Columns whose display name is not in the schema are resolved from their content,
+    those lookups are kept in a small side cache.
+    """
+    def __init__(self, hs: HTANSchema, columns, content_cache_size=4096):
+        self.hs = hs
+        self.columns = {}
+        self.get_by_content = functools.lru_cache(maxsize=content_cache_size)(self._get_by_content)
+        for column in columns or []:
+            self.columns[column] = self._compile_column(column)
+        self._index()
+
+    def _index(self):
+        """Index the columns by the slots a Row reads: the path of classes and the class they map to.
+        Entries are (position, column, mapping) in column order.
+        """
+        self.at_path = defaultdict(list)
+        self.with_id = defaultdict(list)
+        self.content_columns = []
+        self._under = {}
+        self._dependencies = {}
+        for position, (column, mapping) in enumerate(self.columns.items()):
+            if mapping is CONTENT_DEPENDENT:
+                self.content_columns.append((position, column))
+                continue
+            if not mapping:
+                continue
+            entry = (position, column, mapping)
+            self.with_id[mapping.id].append(entry)
+            if not mapping.in_assay:
+                self.at_path[mapping.path].append(entry)
+        # entries placed below bts:Thing in classes other than the THING_CLASSES
+        self.top_level = [_ for _ in self.under(('bts:Thing',)) if _[2].path[1] not in THING_CLASSES + ('bts:Filename', 'bts:FileFormat')]
+        # (position, slot, column) of the columns a Row keeps in its slots
+        self.slot_entries = sorted(
+            (position, SLOT[path], column) for path in ROW_SLOTS for position, column, _ in self.at_path.get(path, [])
+        )
+
+    def under(self, prefix) -> list[tuple[int, str, ColumnMapping]]:
+        """Return the entries placed below a path of classes."""
+        entries = self._under.get(prefix, None)
+        if entries is None:
+            entries = self._under[prefix] = sorted(
+                entry for path, _ in self.at_path.items() if len(path) > len(prefix) and path[:len(prefix)] == prefix for entry in _
+            )
+        return entries
+
+    def dependencies(self, assay_dependencies) -> list[tuple[int, str, ColumnMapping]]:
+        """Return the entries of an assay's dependencies."""
+        entries = self._dependencies.get(assay_dependencies, None)
+        if entries is None:
+            entries = self._dependencies[assay_dependencies] = sorted(
+                entry for _id in assay_dependencies for entry in self.with_id.get(_id, [])
+            )
+        return entries
+
+    def _compile(self, node) -> ColumnMapping | None:
+        if not node:
+            return None
+        path = self.hs.get_path(node)
+        return ColumnMapping(node['@id'], tuple(path[:-1]), path[-1], 'bts:Assay' in path, tuple(path))
+
+    def _compile_column(self, column):
+        if column == 'Biospecimen':
+            return self._compile(self.hs.get_by_id("bts:HTANBiospecimenID"))
+        if column == 'Assay':
+            return self._compile(self.hs.get_by_id("bts:AssayType"))
+        node = self.hs.get_by_display_name(column)
+        if not node:
+            return CONTENT_DEPENDENT
+        return self._compile(node)
+
+    def _get_by_content(self, content) -> ColumnMapping | None:
+        return self._compile(self.hs.get_by_content(content))
+
+    def get(self, column, content) -> ColumnMapping | None:
+        """Return the mapping of a cell, None if the schema has no node for it."""
+        mapping = self.columns.get(column, None)
+        if mapping is None and column not in self.columns:
+            mapping = self.columns[column] = self._compile_column(column)
+            self._index()
+        if mapping is CONTENT_DEPENDENT:
+            return self.get_by_content(content) if content else None
+        return mapping
+
+
+class AssayResolution(NamedTuple):
+    """The classes an (Assay, Level) pair of the table renders into."""
+    assay_klass: str
+    assay_parent_klass: str | None
+    assay_grandparent_klass: str | None
+    assay_dependencies: frozenset[str]
+
+
+# dependencies of assays we create for assay types that are not in the schema
+CREATED_ASSAY_DEPENDENCIES = frozenset(["bts:HTANParticipantID", "bts:HTANBiospecimenID", "bts:HTANParentBiospecimenID", "bts:HTANDataFileID"])
+
+
+class AssayResolver:
+    """Navigates from the table's assay type to the schema's assay, memoized per (Assay, Level).
+    Warnings about the assay type are logged once per pair, when it is first resolved.
+    """
+    def __init__(self, hs: HTANSchema, log=None):
+        self.hs = hs
+        self.log = log or (lambda msg: print(msg, file=sys.stderr))
+        self.resolutions = {}
+        self.hits = 0
+        self.misses = 0
+
+    def cache_info(self) -> dict:
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self.resolutions)}
+
+    def resolve(self, assay, level) -> AssayResolution:
+        key = (assay, level)
+        resolution = self.resolutions.get(key, None)
+        if resolution:
+            self.hits += 1
+            return resolution
+        self.misses += 1
+        resolution = self.resolutions[key] = self._resolve(assay, level)
+        return resolution
+
+    def _resolve(self, assay, level) -> AssayResolution:
+        hs = self.hs
+        assay_type = hs.get_by_content(content=assay)
+        if not assay_type:
+            assay_type = hs.get_by_display_name(display_name=assay)
+        if not assay_type:
+            self.log(f"Assay type {assay} not found in the schema")
+            # create an assay type
+            return AssayResolution(('ohsu:' + assay + level).replace(" ", ""), "bts:Assay", "bts:Thing", CREATED_ASSAY_DEPENDENCIES)
+
+        assay_type_parent = assay_type['rdfs:subClassOf'][0]['@id']
+        if assay_type_parent == 'bts:DataType':
+            self.log(f"Assay type {assay} parent not an bts:Assay is {assay_type_parent}")
+            # create an assay type
+            return AssayResolution('ohsu:' + assay.replace(" ", ""), "bts:Assay", "bts:Thing", CREATED_ASSAY_DEPENDENCIES)
+
+        assay_type_klass = assay_type['@id']
+        assay_id = hs.get_by_id(assay_type_parent)['rdfs:subClassOf'][0]['@id']
+        # assays have levels
+        assay_id = assay_id + level.replace(" ", "")
+        assay_node = hs.get_by_id(assay_id)
+        assert assay_node, f"Assay {assay_type_klass} {assay_type_parent} {assay_id} not found in the schema"
+        # TODO - get the dependencies of 'sms:requiresComponent'
+        assay_dependencies = frozenset(_['@id'] for _ in assay_node['sms:requiresDependency'])
+        assay_parent_klass = assay_node['rdfs:subClassOf'][0]['@id']
+        assay_grandparent_klass = None
+        parent = hs.get_by_id(assay_parent_klass)
+        if parent.get('rdfs:subClassOf', []):
+            assay_grandparent_klass = parent['rdfs:subClassOf'][0]['@id']
+        return AssayResolution(assay_node['@id'], assay_parent_klass, assay_grandparent_klass, assay_dependencies)
+
 
 def tree():
     """A recursive defaultdict"""
     return defaultdict(tree)
 
 
-def normalize(data_path="table_data.tsv", skip_empty=True, sample_assays=False) -> Generator[dict, None, None]:
+@contextlib.contextmanager
+def open_table(source):
+    """Open a tsv table: a path, '-' for stdin, a path ending in .gz for gzip, or a file-like which is left open."""
+    if hasattr(source, 'read'):
+        yield source
+    elif source == '-':
+        yield sys.stdin
+    elif str(source).endswith('.gz'):
+        with gzip.open(source, mode='rt') as file:
+            yield file
+    else:
+        with open(source, mode='r') as file:
+            yield file
+
+
+@contextlib.contextmanager
+def table_rows(source):
+    """Yield the columns and an iterator of the rows (dicts keyed by column) of a table, see open_table().
+    The source can also be an iterable of rows, its columns are the first row's.
+    """
+    if isinstance(source, (str, os.PathLike)) or hasattr(source, 'read'):
+        with open_table(source) as file:
+            reader = csv.DictReader(file, delimiter='\t')
+            yield reader.fieldnames, reader
+        return
+    rows = iter(source)
+    first = next(rows, None)
+    if first is None:
+        yield [], iter(())
+        return
+    yield list(first), itertools.chain([first], rows)
+
+
+def normalize(data_path="table_data.tsv", skip_empty=True, sample_assays=False, assay_resolver=None, flat=False, report: RunReport = None) -> Generator[dict, None, None]:
     """Normalize the data in the table into the BTS schema.
+    The table is a path, '-' for stdin, a gzip'ed path, a file-like, or an iterable of rows, see table_rows().
     Returns a generator of the normalized data.  The dict's key is bts_Thing and the value is the normalized data.
     bts_Thing's children are the various bts: classes in the schema.
+    Pass an AssayResolver to share its cache, or to inspect its hit/miss counts.
+    With flat, the generator yields a Row per table row instead, its tree() is the dict.
+    Given a RunReport, the rows read and skipped, and the columns without a mapping, are counted.
     """
     # TODO - nothing elegant about this code but it gets the job done
-    hs = HTANSchema("HTAN.model.jsonld")
+    if assay_resolver:
+        hs = assay_resolver.hs
+    else:
+        hs = HTANSchema("HTAN.model.jsonld")
+        assay_resolver = AssayResolver(hs)
+    with table_rows(data_path) as (columns, rows):
+        plan = ColumnPlan(hs, columns)
+        if report is not None:
+            report.cache('column_plan', plan.get_by_content.cache_info)
+        yield from normalize_rows(rows, plan, assay_resolver, skip_empty=skip_empty, sample_assays=sample_assays, flat=flat, report=report)
+
+
+def normalize_rows(rows, plan: ColumnPlan, assay_resolver: AssayResolver, skip_empty=True, sample_assays=False, flat=False,
+                   report: RunReport = None) -> Generator[dict, None, None]:
+    """Normalize rows of a table (dicts keyed by column), see normalize().
+    With flat, yields a Row per table row instead of the nested dict.
+    """
     assay_types_seen_already = set()
-    logged_already = set()
-    with open(data_path, mode='r') as file:
-        reader = csv.DictReader(file, delimiter='\t')
-        for row in reader:
-            if sample_assays and row['Assay'] in assay_types_seen_already:
+    for row in rows:
+        if report is not None:
+            report.count('rows_read')
+        if sample_assays and row['Assay'] in assay_types_seen_already:
+            if report is not None:
+                report.count('rows_skipped_sample_assays')
+            continue
+        if row['HTAN Participant ID'] == '':
+            # some rows have two biospecimens
+            _biospecimen = row['Biospecimen'].split(',')[0]
+            _biospecimen = _biospecimen.replace(" ", "")
+            row['HTAN Participant ID'] = '_'.join(_biospecimen.split('_')[:-1])
+        # render Assay
+        assay_types_seen_already.add(row['Assay'])
+        normalized = Row(plan, row, assay_resolver.resolve(row['Assay'], row.get('Level')), skip_empty=skip_empty)
+        if report is not None:
+            report.missing_mapping.update(normalized.missing_mapping().keys())
+        yield normalized if flat else normalized.tree()
+
+
+# marker for a cell skipped for being empty
+SKIPPED = object()
+
+
+def merged_entries(entries, content, path=None, prefix=None, ids=None) -> list[tuple[int, str, ColumnMapping]]:
+    """Merge a plan's entries with a row's content entries at path, below prefix or with an id in ids."""
+    if not content:
+        return entries
+    matched = []
+    for entry in content:
+        mapping = entry[2]
+        if ids is not None:
+            if mapping.id in ids:
+                matched.append(entry)
+        elif mapping.in_assay:
+            continue
+        elif path is not None:
+            if mapping.path == path:
+                matched.append(entry)
+        elif len(mapping.path) > len(prefix) and mapping.path[:len(prefix)] == prefix:
+            matched.append(entry)
+    if not matched:
+        return entries
+    return sorted(entries + matched)
+
+
+def nested_children(entries, cell, depth) -> dict:
+    """Return the cells of entries below a path of classes of length depth, keyed by the next class, deeper ones as nested dicts.
+    cell(column) returns a column's cell, or SKIPPED.
+    """
+    children = {}
+    for _, column, mapping in entries:
+        value = cell(column)
+        if value is SKIPPED:
+            continue
+        branch = children
+        for p in mapping.path[depth:-1]:
+            if not isinstance(branch.get(p, None), dict):
+                branch[p] = {'_': branch[p]} if isinstance(branch.get(p, None), str) else {}
+            branch = branch[p]
+        branch[mapping.leaf] = value
+    return children
+
+
+class Row:
+    """A normalized row of the table, the flat alternative to the nested dict of normalize().
+    It keeps the table row, its assay resolution and the values of the ROW_SLOTS, other values are
+    read through the column plan (the columns at a path of classes) instead of being copied into a tree.
+    tree() renders the nested dict.
+    """
+    __slots__ = ('plan', 'row', 'assay', 'skip_empty', 'content', 'values')
+
+    def __init__(self, plan: ColumnPlan, row: dict, assay: AssayResolution, skip_empty=True):
+        self.plan = plan
+        self.row = row
+        self.assay = assay
+        self.skip_empty = skip_empty
+        # columns whose class depends on the cell
+        self.content = None
+        entries = plan.slot_entries
+        for position, column in plan.content_columns:
+            value = self._cell(column)
+            if value is SKIPPED:
                 continue
-            if row['HTAN Participant ID'] == '':
-                # some rows have two biospecimens
-                _biospecimen = row['Biospecimen'].split(',')[0]
-                _biospecimen = _biospecimen.replace(" ", "")
-                row['HTAN Participant ID'] = '_'.join(_biospecimen.split('_')[:-1])
-            # render Assay
-            # navigate to from assay type to assay
-            assay_types_seen_already.add(row['Assay'])
-            assay_dependencies = []
-            assay_type = assay_type_parent = assay_type_klass = assay_id = assay_parent_klass = assay_grandparent_klass = None
-            assay_type = hs.get_by_content(content=row['Assay'])
-            if not assay_type:
-                assay_type = hs.get_by_display_name(display_name=row['Assay'])
-            if not assay_type:
-                msg = f"Assay type {row['Assay']} not found in the schema"
-                if msg not in logged_already:
-                    print(msg, file=sys.stderr)
-                    logged_already.add(msg)
-            if assay_type:
-                assay_type_parent = assay_type['rdfs:subClassOf'][0]['@id']
-                if assay_type_parent == 'bts:DataType':
-                    msg = f"Assay type {row['Assay']} parent not an bts:Assay is {assay_type_parent}"
-                    if msg not in logged_already:
-                        print(msg, file=sys.stderr)
-                        logged_already.add(msg)
-                    assay_grandparent_klass = "bts:Thing"
-                    assay_parent_klass = "bts:Assay"
-                    # create an assay type
-                    assay_klass = 'ohsu:' + row['Assay'].replace(" ", "")
-                    assay_dependencies = ["bts:HTANParticipantID", "bts:HTANBiospecimenID", "bts:HTANParentBiospecimenID", "bts:HTANDataFileID"]
-                else:
-                    assay_type_klass = assay_type['@id']
-                    assay_id = hs.get_by_id(assay_type['rdfs:subClassOf'][0]['@id'])['rdfs:subClassOf'][0]['@id']
-                    # assays have levels
-                    level = row['Level'].replace(" ", "")
-                    assay_id = assay_id + level
-                    assay = hs.get_by_id(assay_id)
-                    assert assay, f"Assay {assay_type_klass} {assay_type['rdfs:subClassOf'][0]['@id']} {assay_id} not found in the schema"
-                    # TODO - get the dependencies of 'sms:requiresComponent'
-                    assay_dependencies = [_['@id'] for _ in assay['sms:requiresDependency']]
-                    assay_klass = assay['@id']
-                    assay_parent_klass = assay['rdfs:subClassOf'][0]['@id']
-                    parent = hs.get_by_id(assay_parent_klass)
-                    if parent.get('rdfs:subClassOf', []):
-                        assay_grandparent_klass = parent['rdfs:subClassOf'][0]['@id']
-            else:
-                assay_grandparent_klass = "bts:Thing"
-                assay_parent_klass = "bts:Assay"
-                # create an assay type
-                assay_klass = ('ohsu:' + row['Assay'] + row['Level']).replace(" ", "")
-                assay_dependencies = ["bts:HTANParticipantID", "bts:HTANBiospecimenID", "bts:HTANParentBiospecimenID", "bts:HTANDataFileID"]
-
-            # render other datatypes
-            model = defaultdict(tree)
-            for column in row.keys():
-                # skip if empty
-                if skip_empty and not row[column]:
-                    continue
-                # get the node of the schema
-                if column == 'Biospecimen':
-                    n = hs.get_by_id("bts:HTANBiospecimenID")
-                elif column == 'Assay':
-                    n = hs.get_by_id("bts:AssayType")
-                else:
-                    n = hs.get_column(display_name=column, content=row[column])
-                if not n:
-                    model['MISSING_MAPPING'][column] = row[column] if row[column] else None
-                    continue
-                # fill the assay dependencies
-                if n['@id'] in assay_dependencies:
-                    # print(assay_grandparent_klass, assay_parent_klass, assay_klass, n['@id'], file=sys.stderr)
-                    # print('\t', model[assay_grandparent_klass][assay_parent_klass], file=sys.stderr)
-                    model[assay_grandparent_klass][assay_parent_klass][assay_klass][n['@id']] = row[column] if row[column] else None
-                    # continue
-                # and any other class's dependencies
-                path = []
-                while n:
-                    path.append(n['@id'])
-                    if n['rdfs:subClassOf']:
-                        n = hs.get_by_id(n['rdfs:subClassOf'][0]['@id'])
-                    else:
-                        n = None
-                path.reverse()
-
-                # print(path, file=sys.stderr)
-                if 'bts:Assay' not in path:
-                    model_content = model
-                    for p in path:
-                        if p == path[-1]:
-                            model_content[p] = row[column] if row[column] else None
-                            break
-                        else:
-                            if isinstance(model_content[p], str):
-                                _ = model_content[p]
-                                model_content[p] = {'_': _}
-                        model_content = model_content[p]
-
-            # clean up model: move nodes to correct child
-            for k in ["bts:Filename", "bts:FileFormat"]:
-                thing = model["bts:Thing"]
-                if k in thing:
-                    thing["bts:InformationContentEntity"]["bts:File"][k] = thing.pop(k)
-
-            if 'bts:HTANParticipantID' not in model['bts:Thing']["bts:IndividualOrganism"]['bts:Patient']:
-                model['bts:Thing']["bts:IndividualOrganism"]['bts:Patient']['bts:HTANParticipantID'] = row['HTAN Participant ID']
-
-            if 'bts:HTANParticipantID' not in model['bts:Thing']['bts:Biosample']['bts:Biospecimen']:
-                model['bts:Thing']['bts:Biosample']['bts:Biospecimen']['bts:HTANParticipantID'] = row['HTAN Participant ID']
-
-            # move DataType to our constructed assay
-            if "bts:DataType" in model['bts:Thing']["bts:Publication"]:
-                dt = model['bts:Thing']["bts:Publication"].pop("bts:DataType")
-                dt_k = list(dt.keys())[0]
-                as_k = list(model['bts:Thing']["bts:Assay"].keys())[0]
-                for _k, v in dt[dt_k].items():
-                    model['bts:Thing']["bts:Assay"][as_k][_k] = v
-
-            # move Participant, Specimens to our constructed assay
+            mapping = plan.get(column, value)
+            if mapping:
+                if self.content is None:
+                    self.content = []
+                self.content.append((position, column, mapping))
+                if not mapping.in_assay and mapping.path in SLOT:
+                    entries = sorted(entries + [(position, SLOT[mapping.path], column)])
+        # fill the slots, the last cell wins
+        self.values = values = [SKIPPED] * len(ROW_SLOTS)
+        for _, slot, column in entries:
+            value = self._cell(column)
+            if value is not SKIPPED:
+                values[slot] = value
+
+    def _cell(self, column):
+        value = self.row.get(column, None)
+        if self.skip_empty and not value:
+            return SKIPPED
+        return value if value else None
+
+    def _entries(self, entries, path=None, prefix=None, ids=None) -> list[tuple[int, str, ColumnMapping]]:
+        """Merge the plan's entries with the row's content cells, see merged_entries()."""
+        return merged_entries(entries, self.content, path=path, prefix=prefix, ids=ids)
+
+    def value(self, path, default=None):
+        """Return the value placed at a path of classes, the last cell wins."""
+        slot = SLOT.get(path, None)
+        if slot is not None:
+            value = self.values[slot]
+            return default if value is SKIPPED else value
+        value = default
+        for _, column, _mapping in self._entries(self.plan.at_path.get(path, []), path=path):
+            cell = self._cell(column)
+            if cell is not SKIPPED:
+                value = cell
+        return value
+
+    def children(self, prefix) -> dict:
+        """Return the values placed below a path of classes, keyed by the next class, deeper ones as nested dicts."""
+        return nested_children(self._entries(self.plan.under(prefix), prefix=prefix), self._cell, len(prefix))
+
+    def participant_id(self):
+        return self.value(PATIENT + ('bts:HTANParticipantID',), default=self.row['HTAN Participant ID'])
+
+    def biospecimen_participant_id(self):
+        return self.value(BIOSPECIMEN + ('bts:HTANParticipantID',), default=self.row['HTAN Participant ID'])
+
+    def assay_values(self) -> dict:
+        """Return the values gathered under the row's assay class."""
+        values = {}
+        dependencies = self.assay.assay_dependencies
+        for _, column, mapping in self._entries(self.plan.dependencies(dependencies), ids=dependencies):
+            cell = self._cell(column)
+            if cell is not SKIPPED:
+                values[mapping.id] = cell
+        # move DataType to our constructed assay
+        data_type = self.children(DATA_TYPE)
+        if data_type:
+            values.update(next(iter(data_type.values())))
+        # move Participant, Specimens to our constructed assay, a missing id is an empty dict like the tree's
+        values['bts:HTANParticipantID'] = self.biospecimen_participant_id()
+        values['bts:HTANBiospecimenID'] = self.value(BIOSPECIMEN + ('bts:HTANBiospecimenID',), default={})
+        values['bts:HTANParentBiospecimenID'] = self.value(BIOSPECIMEN + ('bts:HTANParentBiospecimenID',), default={})
+        return values
+
+    def file_values(self) -> tuple:
+        """Return the file id, synapse id, data access, participant id, filename and format of the row's file.
+        A missing value is an empty dict like the tree's.
+        """
+        return (
+            self.value(FILE + ('bts:HTANDataFileID',), default={}),
+            self.value(FILE + ('bts:SynapseID',), default={}),
+            self.value(FILE + ('bts:DataAccess',), default={}),
+            self.biospecimen_participant_id(),
+            self.value(('bts:Thing', 'bts:Filename'), default=self.value(FILE + ('bts:Filename',), default={})),
+            self.value(('bts:Thing', 'bts:FileFormat'), default=self.value(FILE + ('bts:FileFormat',), default={})),
+        )
+
+    def missing_mapping(self) -> dict:
+        """Return the cells of the columns the schema has no node for, the nested dict's MISSING_MAPPING."""
+        missing = {}
+        for column, mapping in self.plan.columns.items():
+            if mapping and mapping is not CONTENT_DEPENDENT:
+                continue
+            cell = self._cell(column)
+            if cell is SKIPPED:
+                continue
+            if not mapping or not self.plan.get(column, cell):
+                missing[column] = cell
+        return missing
+
+    def things(self) -> Generator[tuple[str, 'Row'], None, None]:
+        """Yield (class, self) for the classes below bts:Thing, like the items of the nested dict's bts:Thing."""
+        for klass in THING_CLASSES:
+            yield klass, self
+        # others are not rendered to FHIR, fhirized() reports them
+        entries = self.plan.top_level
+        if not entries and not self.content:
+            return
+        others = []
+        for _, column, mapping in self._entries(entries, prefix=('bts:Thing',)):
+            klass = mapping.path[1]
+            if klass in THING_CLASSES or klass in others or klass in ('bts:Filename', 'bts:FileFormat'):
+                continue
+            if self._cell(column) is not SKIPPED:
+                others.append(klass)
+                yield klass, self
+
+    def tree(self) -> dict:
+        """Return the row as the nested dict of normalize()."""
+        assay_klass, assay_parent_klass, assay_grandparent_klass, assay_dependencies = self.assay
+        plan, row, skip_empty = self.plan, self.row, self.skip_empty
+        # render other datatypes
+        model = defaultdict(tree)
+        for column, value in row.items():
+            # skip if empty
+            if skip_empty and not value:
+                continue
+            value = value if value else None
+            # get the node of the schema
+            n = plan.get(column, value)
+            if not n:
+                model['MISSING_MAPPING'][column] = value
+                continue
+            # fill the assay dependencies
+            if n.id in assay_dependencies:
+                model[assay_grandparent_klass][assay_parent_klass][assay_klass][n.id] = value
+            # and any other class's dependencies
+            if not n.in_assay:
+                model_content = model
+                for p in n.parents:
+                    if isinstance(model_content[p], str):
+                        _ = model_content[p]
+                        model_content[p] = {'_': _}
+                    model_content = model_content[p]
+                model_content[n.leaf] = value
+
+        # clean up model: move nodes to correct child
+        for k in ["bts:Filename", "bts:FileFormat"]:
+            thing = model["bts:Thing"]
+            if k in thing:
+                thing["bts:InformationContentEntity"]["bts:File"][k] = thing.pop(k)
+
+        if 'bts:HTANParticipantID' not in model['bts:Thing']["bts:IndividualOrganism"]['bts:Patient']:
+            model['bts:Thing']["bts:IndividualOrganism"]['bts:Patient']['bts:HTANParticipantID'] = row['HTAN Participant ID']
+
+        if 'bts:HTANParticipantID' not in model['bts:Thing']['bts:Biosample']['bts:Biospecimen']:
+            model['bts:Thing']['bts:Biosample']['bts:Biospecimen']['bts:HTANParticipantID'] = row['HTAN Participant ID']
+
+        # move DataType to our constructed assay
+        if "bts:DataType" in model['bts:Thing']["bts:Publication"]:
+            dt = model['bts:Thing']["bts:Publication"].pop("bts:DataType")
+            dt_k = list(dt.keys())[0]
             as_k = list(model['bts:Thing']["bts:Assay"].keys())[0]
-            model['bts:Thing']["bts:Assay"][as_k]['bts:HTANParticipantID'] = model['bts:Thing']['bts:Biosample']['bts:Biospecimen']['bts:HTANParticipantID']
-            model['bts:Thing']["bts:Assay"][as_k]['bts:HTANBiospecimenID'] = model['bts:Thing']['bts:Biosample']['bts:Biospecimen']['bts:HTANBiospecimenID']
-            model['bts:Thing']["bts:Assay"][as_k]['bts:HTANParentBiospecimenID'] = model['bts:Thing']['bts:Biosample']['bts:Biospecimen']['bts:HTANParentBiospecimenID']
-            # and file
-            model['bts:Thing']["bts:InformationContentEntity"]["bts:File"]['bts:HTANParticipantID'] = model['bts:Thing']['bts:Biosample']['bts:Biospecimen']['bts:HTANParticipantID']
+            for _k, v in dt[dt_k].items():
+                model['bts:Thing']["bts:Assay"][as_k][_k] = v
+
+        # move Participant, Specimens to our constructed assay
+        as_k = list(model['bts:Thing']["bts:Assay"].keys())[0]
+        model['bts:Thing']["bts:Assay"][as_k]['bts:HTANParticipantID'] = model['bts:Thing']['bts:Biosample']['bts:Biospecimen']['bts:HTANParticipantID']
+        model['bts:Thing']["bts:Assay"][as_k]['bts:HTANBiospecimenID'] = model['bts:Thing']['bts:Biosample']['bts:Biospecimen']['bts:HTANBiospecimenID']
+        model['bts:Thing']["bts:Assay"][as_k]['bts:HTANParentBiospecimenID'] = model['bts:Thing']['bts:Biosample']['bts:Biospecimen']['bts:HTANParentBiospecimenID']
+        # and file
+        model['bts:Thing']["bts:InformationContentEntity"]["bts:File"]['bts:HTANParticipantID'] = model['bts:Thing']['bts:Biosample']['bts:Biospecimen']['bts:HTANParticipantID']
 
-            yield model
+        return model
 
 
 def dict_md5(d):
@@ -263,236 +745,767 @@ def dict_md5(d):
     return hash_obj.hexdigest()
 
 
-def _to_id(_id: str):
-    """Convert a string to a valid FHIR id."""
-    return _id.replace(":", "_").replace(" ", "").replace("_", "-").replace(",", "-")
+def _text(value) -> str | None:
+    """Return a value for display, None for a missing one (an empty tree() has no stable repr)."""
+    return value if isinstance(value, str) else None
 
 
-def fhirized(thing, htan_type) -> list[dict]:
-    """Convert a BTS thing to FHIR resources."""
-    if htan_type == 'bts_Assay':
-        assay_type = next(iter(thing.keys()))
-        thing = next(iter(thing.values()))
-        specimen_id = thing.get('bts:HTANBiospecimenID', thing.get('bts:HTANParentBiospecimenID'))
-        assert specimen_id, (assay_type, thing)
-        specimen_ids = specimen_id.split(',')
-        inputs = [
-                {
-                    'type': {
-                        'coding': [
-                            {
-                                'system': "http://hl7.org/fhir/fhir-types",
-                                'code': 'Patient',
-                                'display': 'Patient'
-                            }
-                        ]
-                    },
-                    'valueReference': {
-                        'reference': f"Patient/{_to_id(thing['bts:HTANParticipantID'])}"
-                    }
-                }
-            ]
-        inputs.extend([
+# Precompiled parts of the FHIR resources, shared by all the resources rendered: never mutate them.
+def _coding_template(system, code) -> dict:
+    return {'coding': [{'system': system, 'code': code, 'display': code}]}
+
+
+FHIR_TYPE = {_: _coding_template("http://hl7.org/fhir/fhir-types", _) for _ in ('Patient', 'Specimen', 'DocumentReference')}
+# Task inputs of the values gathered under an assay class, by key
+_bts_input_types = {}
+# Task code, by htan_type
+_task_codes = {}
+# values gathered under the assay class that are not Task inputs
+TASK_INPUTS_SKIPPED = frozenset(['bts:HTANParentBiospecimenID', 'bts:HTANParticipantID', 'bts:Filename', 'bts:HTANDataFileID', 'bts:HTANBiospecimenID', '_id', '_type'])
+RESEARCH_STUDY_REFERENCE = {'reference': "ResearchStudy/HTA9"}  # TODO {_to_id(thing['bts:HTANCenterID'])}
+
+
+def _bts_input_type(k) -> dict:
+    input_type = _bts_input_types.get(k, None)
+    if input_type is None:
+        input_type = _bts_input_types[k] = _coding_template("http://schema.biothings.io/", k.replace("bts:", ""))
+    return input_type
+
+
+def _task_code(htan_type) -> dict:
+    code = _task_codes.get(htan_type, None)
+    if code is None:
+        code = _task_codes[htan_type] = _coding_template("https://htan.org", htan_type)
+    return code
+
+
+def _task(assay_type, thing, htan_type) -> dict:
+    """Render the Task of an assay, thing has the values gathered under the assay class."""
+    specimen_id = thing.get('bts:HTANBiospecimenID', thing.get('bts:HTANParentBiospecimenID'))
+    assert specimen_id, (assay_type, thing)
+    specimen_ids = specimen_id.split(',')
+    participant_reference = {'reference': f"Patient/{_to_id(thing['bts:HTANParticipantID'])}"}
+    inputs = [{'type': FHIR_TYPE['Patient'], 'valueReference': participant_reference}]
+    inputs.extend([
+        {'type': _bts_input_type(k), "valueString": v}
+        for k, v in thing.items() if k not in TASK_INPUTS_SKIPPED
+    ])
+    specimen_references = [{'reference': f"Specimen/{_to_id(_)}"} for _ in specimen_ids]
+    inputs.extend([
+        {'type': FHIR_TYPE['Specimen'], 'valueReference': _}
+        for _ in specimen_references
+    ])
+    file_id = thing['bts:HTANDataFileID']
+    assay = {
+        'resourceType': "Task",
+        'id': _to_id(file_id + '-' + specimen_id),
+        'identifier': [
+            {
+                "system": "https://htan.org/assay_type",
+                "value": assay_type.replace("bts:", "").replace("ohsu:", "")
+            },
             {
-                'type': {
-                    'coding': [
-                        {
-                            'system': "http://schema.biothings.io/",
-                            'code': k.replace("bts:", ""),
-                            'display': k.replace("bts:", ""),
-                        }
-                    ],
-                },
-                "valueString": v
+                "system": "https://htan.org/HTANDataFileID",
+                "value": file_id
             }
-            for k, v in thing.items() if k not in ['bts:HTANParentBiospecimenID', 'bts:HTANParticipantID', 'bts:Filename', 'bts:HTANDataFileID', 'bts:HTANBiospecimenID', '_id', '_type']
-        ])
-        inputs.extend([
+        ],
+        'status': "requested",
+        'intent': "order",
+        'focus': specimen_references[0],
+        'for': participant_reference,
+        'code': _task_code(htan_type),
+        'description': f"Assay that created {_text(thing.get('bts:Filename'))} file for {_text(thing.get('bts:HTANParentBiospecimenID'))}",
+        'input': inputs,
+        'output': [
             {
-                'type': {
-                    'coding': [
-                        {
-                            'system': "http://hl7.org/fhir/fhir-types",
-                            'code': 'Specimen',
-                            'display': 'Specimen'
-                        }
-                    ]
-                },
+                'type': FHIR_TYPE['DocumentReference'],
                 'valueReference': {
-                    'reference': f"Specimen/{_to_id(specimen_id)}"
+                    'reference': f"DocumentReference/{_to_id(file_id)}"
                 }
             }
-            for specimen_id in specimen_ids
-        ])
-        assay = {
-            'resourceType': "Task",
-             'id': _to_id(thing['bts:HTANDataFileID'] + '-' + specimen_id),
-             'identifier': [
-                 {
-                     "system": "https://htan.org/assay_type",
-                     "value": assay_type.replace("bts:", "").replace("ohsu:", "")
-                 },
-                 {
-                     "system": "https://htan.org/HTANDataFileID",
-                     "value": thing['bts:HTANDataFileID']
-                 }
-             ],
-            'status': "requested",
-            'intent': "order",
-            'focus': {
-                'reference': f"Specimen/{_to_id(specimen_ids[0])}"
+        ]
+    }
+
+    return assay
+
+
+def _patient(participant_id) -> list[dict]:
+    """Render the Patient and its ResearchSubject."""
+    patient = {'resourceType': "Patient",
+               'id': _to_id(participant_id),
+               'identifier': [
+                   {
+                       "system": "https://htan.org",
+                       "value": participant_id
+                   }
+               ]}
+    research_subject = {
+        'resourceType': "ResearchSubject",
+        'id': _to_id(participant_id + '-HTA9'),
+        'subject': {
+            'reference': f"Patient/{_to_id(participant_id)}"
+        },
+        'status': "candidate",
+        'study': RESEARCH_STUDY_REFERENCE
+    }
+    return [patient, research_subject]
+
+
+def _specimens(specimen_ids: str, participant_id) -> list[dict]:
+    """Render the Specimens of comma separated biospecimen ids."""
+    specimen_ids = specimen_ids.split(',')
+    subject = {'reference': f"Patient/{_to_id(participant_id)}"}
+    specimens = []
+    for specimen_id in specimen_ids:
+        specimen = {'resourceType': "Specimen",
+                     'id': _to_id(specimen_id),
+                     'identifier': [
+                         {
+                             "system": "https://htan.org",
+                             "value": specimen_id,
+                         }
+                     ],
+                     'subject': subject
+                     }
+        specimens.append(specimen)
+    return specimens
+
+
+def _document_reference(file_id, synapse_id, data_access, participant_id, filename, file_format) -> dict:
+    """Render the DocumentReference of a data file."""
+    document_reference = {'resourceType': "DocumentReference",
+        'id': _to_id(file_id),
+        'status': "current",
+        'identifier': [
+            {
+              "system": "https://htan.org",
+              "value": file_id,
             },
-            'for': {
-                'reference': f"Patient/{_to_id(thing["bts:HTANParticipantID"])}"
+            {
+              "system": "https://synapse.org",
+              "value": synapse_id,
             },
-            'code': {
-                'coding': [
-                    {
-                        'system': "https://htan.org",
-                        'code': htan_type,
-                        'display': htan_type
-                    }
-                ]
+            {
+                "system": "https://biothings.io/DataAccess",
+                "value": data_access,
             },
-            'description': f"Assay that created {thing['bts:Filename']} file for {thing['bts:HTANParentBiospecimenID']}",
-            'input': inputs,
-            'output': [
-                {
-                    'type': {
-                        'coding': [
-                            {
-                                'system': "http://hl7.org/fhir/fhir-types",
-                                'code': 'DocumentReference',
-                                'display': 'DocumentReference'
-                            }
-                        ]
-                    },
-                    'valueReference': {
-                        'reference': f"DocumentReference/{_to_id(thing['bts:HTANDataFileID'])}"
-                    }
+        ],
+        'subject': {
+            'reference': f"Patient/{_to_id(participant_id)}"
+        },
+        'content': [
+            {
+                'attachment': {
+                    'url': filename,
+                    'contentType': file_format
                 }
-            ]
-         }
+            }
+        ]
+    }
+    return document_reference
+
+
+def _research_study(center_id) -> list[dict]:
+    """Render the ResearchStudy of a center."""
+    return [{
+        'resourceType': "ResearchStudy",
+        'id': _to_id(center_id),
+        'status': "completed",
+    }]
+
+
+def unshared(value):
+    """Return a copy of a resource (or any json value) that shares no dict or list with other resources."""
+    if type(value) is dict:
+        return {k: unshared(v) for k, v in value.items()}
+    if type(value) is list:
+        return [unshared(_) for _ in value]
+    return value
+
+
+def fhirized(thing, htan_type) -> list[dict]:
+    """Convert a BTS thing, or a normalized Row, to FHIR resources, the caller's to modify, see _fhirized()."""
+    return [unshared(_) if _ else _ for _ in _fhirized(thing, htan_type)]
 
-        return [assay]
+
+def _fhirized(thing, htan_type) -> list[dict]:
+    """Convert a BTS thing, or a normalized Row, to FHIR resources.
+    The resources share their constant parts (codings, the ResearchStudy reference ...) with each other
+    and with the module: serialize them, never mutate them.
+    """
+    if isinstance(thing, Row):
+        return fhirized_row(thing, htan_type)
+
+    if htan_type == 'bts_Assay':
+        assay_type = next(iter(thing.keys()))
+        thing = next(iter(thing.values()))
+        return [_task(assay_type, thing, htan_type)]
 
     if htan_type == 'bts_IndividualOrganism':
         thing = thing['bts:Patient']
         assert 'bts:HTANParticipantID' in thing, thing
-        patient = {'resourceType': "Patient",
-                   'id': _to_id(thing['bts:HTANParticipantID']),
-                   'identifier': [
-                       {
-                           "system": "https://htan.org",
-                           "value": thing['bts:HTANParticipantID']
-                       }
-                   ]}
-        research_subject = {
-            'resourceType': "ResearchSubject",
-            'id': _to_id(thing['bts:HTANParticipantID'] + '-HTA9'),
-            'subject': {
-                'reference': f"Patient/{_to_id(thing['bts:HTANParticipantID'])}"
-            },
-            'status': "candidate",
-            'study': {
-                'reference': f"ResearchStudy/HTA9" #  TODO {_to_id(thing['bts:HTANCenterID'])}
-            }
-        }
-        return [patient, research_subject]
+        return _patient(thing['bts:HTANParticipantID'])
 
     if htan_type == 'bts_Biosample':
         biospecimen_type = next(iter(thing.keys()))
         thing = next(iter(thing.values()))
-        specimen_ids = thing['bts:HTANBiospecimenID'].split(',')
-        specimens = []
-        for specimen_id in specimen_ids:
-            specimen = {'resourceType': "Specimen",
-                         'id': _to_id(specimen_id),
-                         'identifier': [
-                             {
-                                 "system": "https://htan.org",
-                                 "value": specimen_id,
-                             }
-                         ],
-                         'subject': {
-                                'reference': f"Patient/{_to_id(thing['bts:HTANParticipantID'])}"
-                         }
-                         }
-            specimens.append(specimen)
-        return specimens
+        return _specimens(thing['bts:HTANBiospecimenID'], thing['bts:HTANParticipantID'])
 
     if htan_type == 'bts_InformationContentEntity':
         thing = thing['bts:File']
-        document_reference = {'resourceType': "DocumentReference",
-            'id': _to_id(thing['bts:HTANDataFileID']),
-            'status': "current",
-            'identifier': [
-                {
-                  "system": "https://htan.org",
-                  "value": thing['bts:HTANDataFileID'],
-                },
-                {
-                  "system": "https://synapse.org",
-                  "value": thing['bts:SynapseID'],
-                },
-                {
-                    "system": "https://biothings.io/DataAccess",
-                    "value": thing['bts:DataAccess'],
-                },
-            ],
-            'subject': {
-                'reference': f"Patient/{_to_id(thing['bts:HTANParticipantID'])}"
-            },
-            'content': [
-                {
-                    'attachment': {
-                        'url': thing['bts:Filename'],
-                        'contentType': thing['bts:FileFormat']
-                    }
-                }
-            ]
-        }
-        return [document_reference]
+        return [_document_reference(thing['bts:HTANDataFileID'], thing['bts:SynapseID'], thing['bts:DataAccess'],
+                                    thing['bts:HTANParticipantID'], thing['bts:Filename'], thing['bts:FileFormat'])]
 
     if htan_type == 'bts_Publication':
         center_id = next(iter(thing['bts:HTANCenterID'].values()))
-        return [{
-            'resourceType': "ResearchStudy",
-            'id': _to_id(center_id),
-            'status': "completed",
-        }]
+        return _research_study(center_id)
 
     assert False, f"Unknown HTAN type {htan_type}"
     return {'resourceType': "TODO"}
 
 
-def main():
-    """Main function, reads HTAN schema, table_data and outputs FHIR."""
-    emitters = {}
-    emitted_already = set()
+def fhirized_row(row: 'Row', htan_type) -> list[dict]:
+    """Convert one of the bts:Thing classes of a normalized Row to FHIR resources, see fhirized()."""
+    if htan_type == 'bts_Assay':
+        return [_task(row.assay.assay_klass, row.assay_values(), htan_type)]
+
+    if htan_type == 'bts_IndividualOrganism':
+        return _patient(row.participant_id())
+
+    if htan_type == 'bts_Biosample':
+        return _specimens(row.value(BIOSPECIMEN + ('bts:HTANBiospecimenID',), default={}), row.biospecimen_participant_id())
+
+    if htan_type == 'bts_InformationContentEntity':
+        return [_document_reference(*row.file_values())]
+
+    if htan_type == 'bts_Publication':
+        center_id = next(iter(row.children(CENTER).values()))
+        return _research_study(center_id)
+
+    assert False, f"Unknown HTAN type {htan_type}"
+    return {'resourceType': "TODO"}
+
+
+def resource_ids(thing, htan_type) -> list[str] | None:
+    """Return the ids of the resources fhirized() renders a BTS thing into, without rendering them.
+    Only for the entities repeated across rows (Patient, Specimen, ResearchStudy), None otherwise.
+    """
+    if isinstance(thing, Row):
+        return _row_resource_ids(thing, htan_type)
+
+    if htan_type == 'bts_IndividualOrganism':
+        participant_id = thing.get('bts:Patient', {}).get('bts:HTANParticipantID', None)
+        if not isinstance(participant_id, str):
+            return None
+        return [_to_id(participant_id), _to_id(participant_id + '-HTA9')]
+
+    if htan_type == 'bts_Biosample':
+        if not thing:
+            return None
+        specimen_id = next(iter(thing.values())).get('bts:HTANBiospecimenID', None)
+        if not isinstance(specimen_id, str):
+            return None
+        return [_to_id(_) for _ in specimen_id.split(',')]
+
+    if htan_type == 'bts_Publication':
+        center = thing.get('bts:HTANCenterID', None)
+        if not isinstance(center, dict) or not center:
+            return None
+        center_id = next(iter(center.values()))
+        if not isinstance(center_id, str):
+            return None
+        return [_to_id(center_id)]
+
+    return None
+
+
+def _row_resource_ids(row: Row, htan_type) -> list[str] | None:
+    """Return the ids of the resources fhirized_row() renders, see resource_ids()."""
+    if htan_type == 'bts_IndividualOrganism':
+        participant_id = row.participant_id()
+        if not isinstance(participant_id, str):
+            return None
+        return [_to_id(participant_id), _to_id(participant_id + '-HTA9')]
+
+    if htan_type == 'bts_Biosample':
+        specimen_id = row.value(BIOSPECIMEN + ('bts:HTANBiospecimenID',))
+        if not isinstance(specimen_id, str):
+            return None
+        return [_to_id(_) for _ in specimen_id.split(',')]
 
-    for normalized in normalize():
-        #
-        for k, thing in normalized['bts:Thing'].items():
+    if htan_type == 'bts_Publication':
+        center = row.children(CENTER)
+        if not center:
+            return None
+        center_id = next(iter(center.values()))
+        if not isinstance(center_id, str):
+            return None
+        return [_to_id(center_id)]
+
+    return None
+
+
+def fhir_resources(normalized_models, emitted_already=None, report: RunReport = None) -> Generator[dict, None, None]:
+    """FHIR-ize the normalized models (nested dicts or Rows), see normalize().
+    Things whose resources are all in emitted_already are skipped without rendering them, and counted in the report.
+    The resources share their constant parts, as _fhirized()'s: serialize them, or unshared() them before modifying them.
+    """
+    for normalized in normalized_models:
+        things = normalized.things() if isinstance(normalized, Row) else normalized['bts:Thing'].items()
+        for k, thing in things:
             k = k.replace(":", "_")
-            for resource in fhirized(thing, k):
+            if emitted_already is not None:
+                ids = resource_ids(thing, k)
+                if ids and all(_ in emitted_already for _ in ids):
+                    if report is not None:
+                        report.count(f"things_emitted_already.{k}")
+                    continue
+            for resource in _fhirized(thing, k):
                 if not resource:
                     continue
+                yield resource
+
+
+def transform(source, schema_path="HTAN.model.jsonld", assay_resolver: AssayResolver = None, emitted_already=None, skip_empty=True) -> Generator[dict, None, None]:
+    """Yield the FHIR resources of a table lazily, the first resource of an id wins.
+    The source is a path, '-' for stdin, a gzip'ed path, a file-like or an iterable of rows, see table_rows().
+    Pass the AssayResolver and emitted_already of a previous call to transform several tables as one.
+    The resources are unshared() copies, the caller's to modify.
+    """
+    if assay_resolver is None:
+        assay_resolver = AssayResolver(HTANSchema(schema_path))
+    if emitted_already is None:
+        emitted_already = set()
+    for resource in fhir_resources(normalize(source, skip_empty=skip_empty, assay_resolver=assay_resolver, flat=True), emitted_already):
+        if resource['id'] in emitted_already:
+            continue
+        emitted_already.add(resource['id'])
+        yield unshared(resource)
+
+
+def read_manifest(manifest_path) -> dict:
+    """Return the {resourceType/id: content hash} manifest of a previous run, empty if there is none."""
+    if not manifest_path or not os.path.exists(manifest_path):
+        return {}
+    with open(manifest_path, "r") as f:
+        return json.load(f)
+
+
+def write_manifest(manifest_path, manifest):
+    """Write the manifest of this run."""
+    tmp_path = f"{manifest_path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(manifest, f, sort_keys=True)
+    os.replace(tmp_path, manifest_path)
+
+
+def serialized(resource, previous=None, dumps=json.dumps) -> tuple[str, str, str | None, str | None]:
+    """Return the resourceType, id, content hash and ndjson line of a resource, see writer.encoder().
+    Given the manifest of a previous run, the resource is hashed and its line is None if the content did not change.
+    """
+    k = resource['resourceType']
+    _id = resource['id']
+    if previous is None:
+        return k, _id, None, dumps(resource)
+    digest = dict_md5(resource)
+    if previous.get(f"{k}/{_id}", None) == digest:
+        return k, _id, digest, None
+    return k, _id, digest, dumps(resource)
+
+
+# state of a transform worker process, see _init_worker()
+_worker = {}
+
+
+def _init_worker(schema_path, skip_empty, manifest_path=None, encoder_name="json", instrumented=False, with_references=False, profiling=False):
+    """Load the schema, and previous manifest, once per worker process, a forked worker inherits the parent's."""
+    if _worker.get('schema_path') != schema_path:
+        _worker['schema_path'] = schema_path
+        _worker['hs'] = HTANSchema(schema_path)
+    if 'previous' not in _worker or _worker.get('manifest_path') != manifest_path:
+        _worker['manifest_path'] = manifest_path
+        _worker['previous'] = read_manifest(manifest_path) if manifest_path else None
+    _worker['skip_empty'] = skip_empty
+    _worker['dumps'] = encoder(encoder_name)
+    _worker['instrumented'] = instrumented
+    _worker['profiling'] = profiling
+    _worker['with_references'] = with_references
+    _worker['plans'] = {}
+    _worker['logged'] = []
+    _worker['assay_resolver'] = AssayResolver(_worker['hs'], log=_worker['logged'].append)
+
+
+def _transform_chunk(chunk) -> tuple[list[tuple[str, str, str | None, str | None, list[str] | None]], list[str], dict | None, dict | None]:
+    """Normalize and FHIR-ize a chunk of rows in a worker process.
+    Returns the serialized() chunk's resources, first one wins, each with its references() when with_references,
+    the warnings logged, when instrumented the chunk's RunReport.as_dict(), and when profiling the chunk's profile_stats().
+    """
+    if not _worker['profiling']:
+        return *_transform_rows(chunk), None
+    profile = cProfile.Profile()
+    profile.enable()
+    transformed = _transform_rows(chunk)
+    profile.disable()
+    return *transformed, profile_stats(profile)
+
+
+def _transform_rows(chunk) -> tuple[list[tuple[str, str, str | None, str | None, list[str] | None]], list[str], dict | None]:
+    fieldnames, rows = chunk
+    plan = _worker['plans'].get(fieldnames, None)
+    if not plan:
+        plan = _worker['plans'][fieldnames] = ColumnPlan(_worker['hs'], fieldnames)
+    assay_resolver = _worker['assay_resolver']
+    report = RunReport() if _worker['instrumented'] else None
+    if report is not None:
+        caches = {'assay_resolver': assay_resolver.cache_info(), 'column_plan': plan.get_by_content.cache_info()._asdict()}
+    emitted_already = set()
+    lines = []
+    with_references = _worker['with_references']
+    normalized = normalize_rows(rows, plan, assay_resolver, skip_empty=_worker['skip_empty'], flat=True, report=report)
+    resources = fhir_resources(normalized if report is None else report.timed(normalized, 'normalize'), emitted_already, report)
+    for resource in resources if report is None else report.timed(resources, 'fhirized'):
+        if report is not None:
+            report.built[resource['resourceType']] += 1
+        if resource['id'] in emitted_already:
+            if report is not None:
+                report.deduplicated[resource['resourceType']] += 1
+            continue
+        emitted_already.add(resource['id'])
+        if report is None:
+            line = serialized(resource, _worker['previous'], _worker['dumps'])
+        else:
+            with report.timer('serialize'):
+                line = serialized(resource, _worker['previous'], _worker['dumps'])
+        lines.append((*line, references(resource) if with_references else None))
+    if report is not None:
+        report.exclusive('fhirized', 'normalize')
+        # the chunk's share of the worker's caches
+        after = {'assay_resolver': assay_resolver.cache_info(), 'column_plan': plan.get_by_content.cache_info()._asdict()}
+        for name, info in after.items():
+            report.worker_caches[name].update(hits=info['hits'] - caches[name]['hits'], misses=info['misses'] - caches[name]['misses'])
+        report = report.as_dict()
+    logged = list(_worker['logged'])
+    _worker['logged'].clear()
+    return lines, logged, report
+
+
+def positioned_tables(data_paths, start=(0, 0)) -> Generator[tuple[int, list[str], Iterator[dict]], None, None]:
+    """Yield the index, columns and rows of the tables, from the start (index of a table, rows of it done) of a resumed run.
+    A table's rows are read when it is yielded.
+    """
+    for i, data_path in enumerate(data_paths):
+        if i < start[0]:
+            continue
+        with table_rows(data_path) as (columns, rows):
+            if i == start[0] and start[1]:
+                rows = itertools.islice(rows, start[1], None)
+            yield i, columns, rows
+
 
-                if resource['id'] in emitted_already:
+def _chunks(data_paths, chunk_size, start=(0, 0)) -> Generator[tuple[tuple[int, int], tuple[tuple[str, ...], list[dict]]], None, None]:
+    """Split the rows of the tables into chunks, yielded with the position (see positioned_tables()) after them."""
+    for i, columns, reader in positioned_tables(data_paths, start):
+        fieldnames = tuple(columns or [])
+        done = start[1] if i == start[0] else 0
+        while True:
+            rows = list(itertools.islice(reader, chunk_size))
+            if not rows:
+                break
+            done += len(rows)
+            yield (i, done), (fieldnames, rows)
+
+
+def data_paths_of(data_path) -> list:
+    """Return the tables of data_path, a table or a list of tables."""
+    if isinstance(data_path, (str, os.PathLike)) or hasattr(data_path, 'read'):
+        return [data_path]
+    return list(data_path)
+
+
+def transform_parallel(data_path, schema_path, workers, chunk_size=2000, skip_empty=True, manifest_path=None, encoder_name="json",
+                       report: RunReport = None, with_references=False, start=(0, 0), chunk_done=None, profiles: Profiles = None) -> Generator[tuple[str, str, str | None, str | None, list[str] | None], None, None]:
+    """Transform the table, or list of tables, on a pool of worker processes.
+    Yields the serialized() resources in table order, with their references() when with_references, they are not deduplicated across chunks.
+    Given a RunReport, the workers' counts and seconds (summed over the workers) are merged into it.
+    The tables are read from start, see positioned_tables(), and chunk_done is called with the position
+    after a chunk once its lines are consumed. Given Profiles, see profiled(), the workers profile the chunks and their stats are added to it.
+    """
+    logged_already = set()
+    instrumented = report is not None
+    # load the schema and manifest before the pool starts, so forked workers share them
+    initargs = (schema_path, skip_empty, manifest_path, encoder_name, instrumented, with_references, profiles is not None)
+    _init_worker(*initargs)
+    with multiprocessing.Pool(workers, initializer=_init_worker, initargs=initargs) as pool:
+        # bound the chunks in flight, so the table is not read into memory ahead of the workers
+        pending = collections.deque()
+        chunks = _chunks(data_paths_of(data_path), chunk_size, start)
+        while True:
+            for position, chunk in itertools.islice(chunks, workers * 2 - len(pending)):
+                pending.append((position, pool.apply_async(_transform_chunk, (chunk,))))
+            if not pending:
+                break
+            position, result = pending.popleft()
+            lines, logged, chunk_report, stats = result.get()
+            if chunk_report:
+                report.merge(chunk_report)
+            if stats:
+                profiles.add(stats)
+            for msg in logged:
+                if msg not in logged_already:
+                    print(msg, file=sys.stderr)
+                    logged_already.add(msg)
+            yield from lines
+            if chunk_done is not None:
+                chunk_done(position)
+
+
+def main(data_path="table_data.tsv", schema_path="HTAN.model.jsonld", output_path="META", workers=1, chunk_size=2000, manifest_path=None,
+         dedupe="memory", dedupe_path=None, dedupe_stats=False, encoder_name="json", compression=None, shard_bytes=None, buffer_bytes=1 << 20,
+         report_path=None, profile_path=None, engine="row", check_references=False, index=False, checkpoint_rows=None, resume=False):
+    """Main function, reads HTAN schema, table_data and outputs FHIR.
+    data_path is a table or a list of tables, see table_rows(), output_path a directory or '-' for stdout.
+    Given a manifest_path, only resources that are new or changed since the manifest was written are output,
+    the references of resources no longer emitted are listed in deleted.txt, and the manifest is updated.
+    The ids emitted already are kept in a dedupe backend: memory, digest or sqlite (at dedupe_path).
+    The resources are serialized with encoder_name (json or fast) and written by a writer.NdjsonWriter,
+    optionally compressed (gzip or zstd) and sharded every shard_bytes, the ndjson files of a previous run in output_path are removed.
+    Given a report_path, the seconds per stage and the counts of the run are written there by a RunReport,
+    given a profile_path, the cProfile stats of the transform loop, merged with those of the workers.
+    engine is row, or columnar to normalize a batch of columns at a time (see columnar.py), in a single process.
+    With check_references, the references to resources never emitted are reported at the end of the run,
+    with the counts per resourceType, by an integrity.ReferenceIndex, see check_summary().
+    With index, the byte offsets of the resources, by Type/id and by the patient and specimen they reference,
+    are written to a lookup.INDEX next to the (uncompressed) ndjson files.
+    Given checkpoint_rows, a checkpoint.Checkpoint of the run is saved in output_path every checkpoint_rows rows,
+    with resume the run continues from the last one, or starts over if there is none.
+    """
+    if engine == "columnar" and workers > 1:
+        raise ValueError("The columnar engine runs in a single process, workers must be 1")
+    if resume and not checkpoint_rows:
+        checkpoint_rows = 100000
+    if checkpoint_rows and (output_path == '-' or compression or manifest_path or index or check_references or engine != "row"):
+        raise ValueError("Checkpoints need an uncompressed output directory, the row engine, and no manifest, index or reference check")
+    report = RunReport() if report_path else None
+    dumps = encoder(encoder_name)
+    if output_path == '-':
+        writer = StreamWriter(sys.stdout, buffer_bytes=buffer_bytes)
+    else:
+        os.makedirs(output_path, exist_ok=True)
+        writer = NdjsonWriter(output_path, compression=compression, shard_bytes=shard_bytes, buffer_bytes=buffer_bytes, positions=index)
+        if not resume:
+            # the files of a previous run that this one doesn't write, e.g. shards or unchanged resourceTypes of a delta, would be left behind
+            writer.clear()
+    emitted_already = dedupe_store(dedupe, timed=dedupe_stats or report is not None, **({'path': dedupe_path} if dedupe_path else {}))
+    previous = read_manifest(manifest_path) if manifest_path else None
+    manifest = {} if manifest_path else None
+    reference_index = ReferenceIndex() if check_references else None
+    index_writer = IndexWriter(output_path) if index else None
+    with_references = check_references or index
+    checkpoint = None
+    start = (0, 0)
+    if checkpoint_rows:
+        checkpoint = Checkpoint(output_path, writer, every_rows=checkpoint_rows, parameters={
+            'data_path': [str(_) for _ in data_paths_of(data_path)], 'schema_path': schema_path, 'encoder': encoder_name, 'shard_bytes': shard_bytes,
+        })
+        if resume:
+            start = checkpoint.restore(emitted_already)
+        else:
+            checkpoint.start()
+
+    def emit(k, _id, digest, line, resource_references=None):
+        if manifest is not None:
+            manifest[f"{k}/{_id}"] = digest
+        if line is None:
+            return
+        position = writer.write(k, line)
+        if index_writer is not None:
+            index_writer.add(k, _id, position, resource_references)
+
+    def deduplicated(k, _id) -> bool:
+        if _id in emitted_already:
+            if report is not None:
+                report.deduplicated[k] += 1
+            return True
+        emitted_already.add(_id)
+        if checkpoint is not None:
+            checkpoint.add(_id)
+        return False
+
+    def checkpointed(i, rows):
+        done = start[1] if i == start[0] else 0
+        for row in rows:
+            yield row
+            # the next row is pulled once the resources of this one are written
+            done += 1
+            checkpoint.advance((i, done))
+
+    with profiled(profile_path) as profiles:
+        if workers > 1:
+            lines = transform_parallel(data_path, schema_path, workers, chunk_size=chunk_size, manifest_path=manifest_path,
+                                       encoder_name=encoder_name, report=report, with_references=with_references,
+                                       start=start, chunk_done=None if checkpoint is None else lambda position: checkpoint.advance(position, chunk_size),
+                                       profiles=profiles)
+            for k, _id, digest, line, resource_references in lines if report is None else report.timed(lines, 'workers'):
+                if deduplicated(k, _id):
+                    continue
+                if reference_index is not None:
+                    reference_index.add(k, _id, resource_references)
+                if report is None:
+                    emit(k, _id, digest, line, resource_references)
+                else:
+                    with report.timer('write'):
+                        emit(k, _id, digest, line, resource_references)
+        else:
+            if report is None:
+                hs = HTANSchema(schema_path)
+            else:
+                with report.timer('schema'):
+                    hs = HTANSchema(schema_path)
+            assay_resolver = AssayResolver(hs)
+            if engine == "columnar":
+                import columnar
+                resources = itertools.chain.from_iterable(
+                    columnar.columnar_resources(_, assay_resolver, emitted_already, report=report) for _ in data_paths_of(data_path)
+                )
+            elif checkpoint is not None:
+                normalized = itertools.chain.from_iterable(
+                    normalize_rows(checkpointed(i, rows), ColumnPlan(hs, columns), assay_resolver, flat=True, report=report)
+                    for i, columns, rows in positioned_tables(data_paths_of(data_path), start)
+                )
+            else:
+                normalized = itertools.chain.from_iterable(
+                    normalize(_, assay_resolver=assay_resolver, flat=True, report=report) for _ in data_paths_of(data_path)
+                )
+            if engine != "columnar":
+                resources = fhir_resources(normalized if report is None else report.timed(normalized, 'normalize'), emitted_already, report)
+            for resource in resources if report is None else report.timed(resources, 'fhirized'):
+                if report is not None:
+                    report.built[resource['resourceType']] += 1
+                if deduplicated(resource['resourceType'], resource['id']):
                     continue
-                emitted_already.add(resource['id'])
+                resource_references = references(resource) if with_references else None
+                if reference_index is not None:
+                    if report is None:
+                        reference_index.add(resource['resourceType'], resource['id'], resource_references)
+                    else:
+                        with report.timer('integrity'):
+                            reference_index.add(resource['resourceType'], resource['id'], resource_references)
+                if report is None:
+                    emit(*serialized(resource, previous, dumps), resource_references)
+                else:
+                    with report.timer('serialize'):
+                        line = serialized(resource, previous, dumps)
+                    with report.timer('write'):
+                        emit(*line, resource_references)
+            if report is not None:
+                report.exclusive('fhirized', 'normalize')
+                report.cache('assay_resolver', assay_resolver.cache_info)
+
+    if report is None:
+        writer.close()
+        if index_writer is not None:
+            index_writer.close()
+    else:
+        with report.timer('write'):
+            writer.close()
+        if index_writer is not None:
+            with report.timer('index'):
+                index_writer.close()
+    if checkpoint is not None:
+        checkpoint.done()
+
+    if dedupe_stats:
+        print(json.dumps({'dedupe': emitted_already.stats()}), file=sys.stderr)
+    if reference_index is not None:
+        summary = reference_index.summary()
+        print(check_summary(summary), file=sys.stderr)
+        if report is not None:
+            report.add('integrity', summary)
+    if report is not None:
+        # the store's lookups of things emitted already are also in the fhirized seconds
+        report.seconds['dedupe'] = emitted_already.seconds
+        report.add('dedupe', emitted_already.stats())
+    emitted_already.close()
+
+    if manifest is not None:
+        with open(os.path.join(output_path, "deleted.txt"), "w") as f:
+            for reference in previous:
+                if reference not in manifest:
+                    f.write(reference)
+                    f.write('\n')
+        write_manifest(manifest_path, manifest)
+
+    if report is not None:
+        report.write(report_path, data_path=data_path, schema_path=schema_path, output_path=output_path, workers=workers,
+                     dedupe=dedupe, encoder=encoder_name, compression=compression, incremental=manifest_path is not None, engine=engine,
+                     check_references=check_references, index=index, resumed_from=list(start))
+
+
+def check_summary(summary: dict) -> str:
+    """Return the lines of a ReferenceIndex.summary(): counts per resourceType, then the dangling references."""
+    lines = [f"{'resourceType':<20} {'emitted':>10} {'referenced':>11} {'dangling':>9}"]
+    for k, counts in summary['resources'].items():
+        lines.append(f"{k:<20} {counts['emitted']:>10} {counts['referenced']:>11} {counts['dangling']:>9}")
+    lines.append(f"{summary['dangling_references']} dangling references to {summary['dangling_targets']} resources")
+    for _ in summary['dangling']:
+        lines.append(f"  {_['reference']} x{_['count']}, first from {_['from']}")
+    return '\n'.join(lines)
+
+
+def run_report_path(output_path) -> str:
+    """Return the path of the run report next to the output directory, e.g. META.report.json, '-' (stderr) for stdout."""
+    if output_path == '-':
+        return '-'
+    return os.path.normpath(output_path) + ".report.json"
 
-                k = resource['resourceType']
-                if k not in emitters:
-                    f = open(f"META/{k}.ndjson", "w")
-                    emitters[k] = f
-                f = emitters.get(k)
-                f.write(json.dumps(resource))
-                f.write('\n')
 
-    for _ in emitters.values():
-        _.close()
+@click.command()
+@click.option('--data', 'data_path', default=["table_data.tsv"], show_default=True, multiple=True,
+              help="HTAN metadata table (tsv), gzip'ed if it ends in .gz, - for stdin. Repeat for several tables.")
+@click.option('--schema', 'schema_path', default="HTAN.model.jsonld", show_default=True, help="HTAN schema (JSON-LD).")
+@click.option('--output', 'output_path', default="META", show_default=True, help="Directory for the FHIR ndjson files, - for ndjson on stdout.")
+@click.option('--workers', default=1, show_default=True, type=click.IntRange(min=1), help="Worker processes, output is identical to a single process run.")
+@click.option('--chunk-size', default=2000, show_default=True, type=click.IntRange(min=1), help="Rows sent to a worker at a time.")
+@click.option('--manifest', 'manifest_path', default=None, help="Incremental mode: output only resources new or changed since this manifest of content hashes, then update it. The ndjson files already in --output are removed.")
+@click.option('--dedupe', default="memory", show_default=True, type=click.Choice(["memory", "digest", "sqlite"]),
+              help="Store of the ids emitted already: a set, 64 bit digests, or an on disk SQLite table.")
+@click.option('--dedupe-path', default=None, help="SQLite database of the sqlite store, a temporary file by default. A previous store there is replaced, any other file is left as is and the run stops.")
+@click.option('--dedupe-stats', is_flag=True, default=False, help="Print the memory use and lookup rate of the store.")
+@click.option('--encoder', 'encoder_name', default="json", show_default=True, type=click.Choice(["json", "fast"]),
+              help="json: the stdlib's default format. fast: compact json, with orjson when installed.")
+@click.option('--compression', default="none", show_default=True, type=click.Choice(["none", "gzip", "zstd"]), help="Compression of the ndjson files.")
+@click.option('--shard-bytes', default=None, type=click.IntRange(min=1), help="Roll the ndjson files over into shards of about this many (uncompressed) bytes.")
+@click.option('--buffer-bytes', default=1 << 20, show_default=True, type=click.IntRange(min=1), help="Bytes buffered per resourceType between writes.")
+@click.option('--report', is_flag=True, default=False, help="Write the seconds per stage and the counts of the run to {output}.report.json.")
+@click.option('--profile', 'profile_path', default=None, help="Dump the cProfile stats of the transform loop, merged with the workers', to this path.")
+@click.option('--check-references', is_flag=True, default=False,
+              help="Report the references to resources not emitted by the run, and counts per resourceType, on stderr.")
+@click.option('--index', is_flag=True, default=False,
+              help="Write the byte offsets of the resources, by id, patient and specimen, to {output}/ndjson.index, see lookup.py.")
+@click.option('--engine', default="row", show_default=True, type=click.Choice(["row", "columnar"]),
+              help="row: a row at a time. columnar: a batch of columns at a time, single process, same output.")
+@click.option('--checkpoint-rows', default=None, type=click.IntRange(min=1),
+              help="Save a checkpoint of the run in the output directory every this many rows [default: 100000 with --resume].")
+@click.option('--resume', is_flag=True, default=False,
+              help="Continue from the last checkpoint in the output directory, truncating what was written after it.")
+def cli(data_path, schema_path, output_path, workers, chunk_size, manifest_path, dedupe, dedupe_path, dedupe_stats, encoder_name, compression, shard_bytes, buffer_bytes,
+        report, profile_path, check_references, index, engine, checkpoint_rows, resume):
+    """Transform HTAN metadata to FHIR."""
+    if engine == "columnar" and workers > 1:
+        raise click.UsageError("--engine columnar runs in a single process, it can't be combined with --workers")
+    if output_path == '-' and (manifest_path or compression != "none" or shard_bytes):
+        raise click.UsageError("--manifest, --compression and --shard-bytes need an --output directory")
+    if index and (output_path == '-' or compression != "none"):
+        raise click.UsageError("--index needs an --output directory, without --compression")
+    if (checkpoint_rows or resume) and (output_path == '-' or compression != "none" or manifest_path or index or check_references or engine != "row"):
+        raise click.UsageError("--checkpoint-rows and --resume need an --output directory, without --compression, --manifest, --index, "
+                               "--check-references or --engine columnar")
+    main(data_path=data_path, schema_path=schema_path, output_path=output_path, workers=workers, chunk_size=chunk_size, manifest_path=manifest_path,
+         dedupe=dedupe, dedupe_path=dedupe_path, dedupe_stats=dedupe_stats,
+         encoder_name=encoder_name, compression=None if compression == "none" else compression, shard_bytes=shard_bytes, buffer_bytes=buffer_bytes,
+         report_path=run_report_path(output_path) if report else None, profile_path=profile_path, engine=engine,
+         check_references=check_references, index=index, checkpoint_rows=checkpoint_rows, resume=resume)
 
 
-main()
+if __name__ == '__main__':
+    cli()
@@ -0,0 +1,160 @@
+"""Stage timers and counters of a run, written as a json report, see model.main()."""
+import collections
+import contextlib
+import cProfile
+import json
+import pstats
+import sys
+import time
+
+
+class RunReport:
+    """Cumulative seconds per stage, counters and cache statistics of a run.
+    The transform takes report=None when instrumentation is off, and only checks for it outside its per row work.
+    """
+    def __init__(self):
+        self.started = time.time()
+        self.seconds = collections.Counter()
+        self.counters = collections.Counter()
+        self.missing_mapping = collections.Counter()
+        self.built = collections.Counter()
+        self.deduplicated = collections.Counter()
+        # name -> cache_info functions, of each ColumnPlan for instance
+        self.caches = collections.defaultdict(list)
+        # hits and misses of the workers' caches
+        self.worker_caches = collections.defaultdict(collections.Counter)
+        self.sections = {}
+
+    @contextlib.contextmanager
+    def timer(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.seconds[stage] += time.perf_counter() - start
+
+    def timed(self, iterable, stage):
+        """Yield from the iterable, adding the time spent in it to the stage.
+        The time of nested timed() iterables is counted by both, see exclusive().
+        """
+        iterator = iter(iterable)
+        seconds = self.seconds
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                seconds[stage] += time.perf_counter() - start
+                return
+            seconds[stage] += time.perf_counter() - start
+            yield item
+
+    def exclusive(self, stage, *nested):
+        """Subtract the time of nested stages from a stage, once they are done."""
+        self.seconds[stage] -= sum(self.seconds[_] for _ in nested)
+
+    def count(self, name, n=1):
+        self.counters[name] += n
+
+    def cache(self, name, cache_info):
+        """Register a cache by its cache_info() function, read when the report is written.
+        The counts of the caches registered under the same name are summed.
+        """
+        if cache_info not in self.caches[name]:
+            self.caches[name].append(cache_info)
+
+    def add(self, name, section: dict):
+        """Add a section, e.g. the dedupe store's stats(), to the report."""
+        self.sections[name] = section
+
+    def merge(self, other: dict):
+        """Add the counts of a worker's as_dict()."""
+        self.seconds.update(other['seconds'])
+        self.counters.update(other['counters'])
+        self.missing_mapping.update(other['missing_mapping'])
+        for k, v in other['resources'].items():
+            self.built[k] += v.get('built', 0)
+            self.deduplicated[k] += v.get('deduplicated', 0)
+        for name, info in other['caches'].items():
+            self.worker_caches[name].update(hits=info['hits'], misses=info['misses'])
+
+    @staticmethod
+    def _summed(infos) -> dict:
+        summed = {}
+        for info in infos:
+            for k, v in (info if isinstance(info, dict) else info._asdict()).items():
+                summed[k] = v if summed.get(k, None) is None or v is None else summed[k] + v
+        return summed
+
+    @staticmethod
+    def _hit_rate(info: dict) -> dict:
+        lookups = info['hits'] + info['misses']
+        return dict(info, hit_rate=round(info['hits'] / lookups, 4) if lookups else None)
+
+    def as_dict(self) -> dict:
+        resources = {k: {'built': v, 'deduplicated': self.deduplicated[k]} for k, v in self.built.items()}
+        caches = {name: self._hit_rate(self._summed(_() for _ in infos)) for name, infos in self.caches.items()}
+        for name, info in self.worker_caches.items():
+            caches[name] = self._hit_rate(dict(info))
+        return {
+            'seconds': {k: round(v, 6) for k, v in self.seconds.items()},
+            'counters': dict(self.counters),
+            'missing_mapping': dict(self.missing_mapping.most_common()),
+            'resources': dict(sorted(resources.items())),
+            'caches': caches,
+        }
+
+    def write(self, path, **parameters):
+        """Write the report, with the run's parameters and wall clock seconds, '-' for stderr."""
+        report = dict(parameters=parameters, wall_seconds=round(time.time() - self.started, 3), **self.as_dict(), **self.sections)
+        if path == '-':
+            print(json.dumps(report), file=sys.stderr)
+            return
+        with open(path, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+class _Stats:
+    """The stats of a cProfile.Profile, as pstats.Stats() loads them."""
+    def __init__(self, stats: dict):
+        self.stats = stats
+
+    def create_stats(self):
+        pass
+
+
+class Profiles:
+    """The cProfile stats of worker processes, dumped with the parent's by profiled()."""
+    def __init__(self):
+        self.stats = []
+
+    def add(self, stats: dict):
+        """Add the stats of a profile, see profile_stats()."""
+        self.stats.append(_Stats(stats))
+
+
+def profile_stats(profile: cProfile.Profile) -> dict:
+    """Return the stats of a disabled profile, picklable to send them to the parent process."""
+    profile.create_stats()
+    return profile.stats
+
+
+@contextlib.contextmanager
+def profiled(path=None):
+    """Profile the block with cProfile, and dump the stats to path (pstats format). A no-op yielding None without a path.
+    Yields Profiles, the workers' stats added to it are merged into the dump.
+    """
+    if not path:
+        yield None
+        return
+    profiles = Profiles()
+    profile = cProfile.Profile()
+    profile.enable()
+    try:
+        yield profiles
+    finally:
+        profile.disable()
+        stats = pstats.Stats(profile)
+        for _ in profiles.stats:
+            stats.add(_)
+        stats.dump_stats(path)
@@ -0,0 +1,247 @@
+"""A long running transform service: the schema and its caches stay loaded between requests.
+
+    python service.py --port 8765  # or --socket /tmp/htan-fhir.sock
+    curl --data-binary @table_data.tsv http://127.0.0.1:8765/transform > fhir.ndjson
+    curl --unix-socket /tmp/htan-fhir.sock --data-binary @table_data.tsv http://localhost/transform
+
+A POSTed tsv (gzip'ed with Content-Encoding: gzip) is transformed as model.transform() does,
+and its ndjson streamed back as it is rendered. The JSON-LD is reloaded when its file changes.
+"""
+import contextlib
+import gzip
+import http.server
+import io
+import json
+import os
+import signal
+import socketserver
+import sys
+import threading
+import time
+import urllib.parse
+import zlib
+
+import click
+
+from model import AssayResolver, ColumnPlan, HTANSchema, fhir_resources, normalize_rows, table_rows
+from writer import encoder
+
+# bytes of ndjson per chunk of the response
+CHUNK_BYTES = 1 << 16
+
+
+class _Schema:
+    """A loaded schema, with the caches built on it."""
+    def __init__(self, schema_path, log):
+        self.stamp = _stamp(schema_path)
+        self.hs = HTANSchema(schema_path)
+        self.assay_resolver = AssayResolver(self.hs, log=log)
+        # ColumnPlan by table header
+        self.plans = {}
+        self.loaded = time.time()
+
+
+def _stamp(path) -> tuple[int, int]:
+    stat = os.stat(path)
+    return stat.st_mtime_ns, stat.st_size
+
+
+class TransformService:
+    """Transforms tables with a resident HTANSchema, AssayResolver and ColumnPlans.
+    Each call checks the JSON-LD's mtime and size and reloads it when they changed. A reload
+    that fails is logged, and the previous schema kept until the file changes again.
+    """
+    def __init__(self, schema_path="HTAN.model.jsonld", encoder_name="json", skip_empty=True, log=None):
+        self.schema_path = schema_path
+        self.dumps = encoder(encoder_name)
+        self.skip_empty = skip_empty
+        self.log = log or (lambda msg: print(msg, file=sys.stderr))
+        self.lock = threading.Lock()
+        self.schema = _Schema(schema_path, self.log)
+        self.failed_stamp = None
+        self.reloads = 0
+        self.requests = 0
+
+    def current(self) -> _Schema:
+        """Return the loaded schema, reloaded first if the file changed."""
+        schema = self.schema
+        try:
+            stamp = _stamp(self.schema_path)
+        except OSError:
+            return schema
+        if stamp == schema.stamp or stamp == self.failed_stamp:
+            return schema
+        with self.lock:
+            if self.schema is schema:
+                try:
+                    self.schema = _Schema(self.schema_path, self.log)
+                    self.reloads += 1
+                    self.log(f"Reloaded {self.schema_path}")
+                except Exception as e:
+                    self.failed_stamp = stamp
+                    self.log(f"Reloading {self.schema_path} failed, keeping the previous schema: {e!r}")
+            return self.schema
+
+    def transform(self, source):
+        """Yield the ndjson lines of a table, see model.table_rows(), the first resource of an id wins."""
+        schema = self.current()
+        with self.lock:
+            self.requests += 1
+        emitted_already = set()
+        with table_rows(source) as (columns, rows):
+            key = tuple(columns or [])
+            plan = schema.plans.get(key, None)
+            if plan is None:
+                plan = schema.plans[key] = ColumnPlan(schema.hs, columns)
+            normalized = normalize_rows(rows, plan, schema.assay_resolver, skip_empty=self.skip_empty, flat=True)
+            for resource in fhir_resources(normalized, emitted_already):
+                if resource['id'] in emitted_already:
+                    continue
+                emitted_already.add(resource['id'])
+                yield self.dumps(resource)
+
+    def status(self) -> dict:
+        schema = self.schema
+        return {
+            'schema': self.schema_path,
+            'loaded': schema.loaded,
+            'reloads': self.reloads,
+            'requests': self.requests,
+            'plans': len(schema.plans),
+            'assay_resolver': schema.assay_resolver.cache_info(),
+        }
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # the headers and the chunks are written separately, don't wait for their ACKs
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def _respond(self, status, body: dict):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _chunk(self, data: bytes):
+        self.wfile.write(b'%x\r\n%s\r\n' % (len(data), data))
+
+    def do_GET(self):
+        if urllib.parse.urlsplit(self.path).path != '/health':
+            return self._respond(404, {'error': f"{self.path} not found, expected /health or POST /transform"})
+        self._respond(200, self.server.service.status())
+
+    def do_POST(self):
+        if urllib.parse.urlsplit(self.path).path != '/transform':
+            return self._respond(404, {'error': f"{self.path} not found, expected POST /transform"})
+        if 'Content-Length' not in self.headers:
+            return self._respond(411, {'error': "Content-Length required"})
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        try:
+            if self.headers.get('Content-Encoding') == 'gzip':
+                body = gzip.decompress(body)
+            text = body.decode()
+        except (OSError, EOFError, zlib.error, UnicodeDecodeError) as e:
+            return self._respond(400, {'error': repr(e)})
+        lines = self.server.service.transform(io.StringIO(text, newline=''))
+        # render the first line before the status, so a table that can't be transformed gets a 400
+        try:
+            first = next(lines, None)
+        except Exception as e:
+            return self._respond(400, {'error': repr(e)})
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/x-ndjson')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        if first is None:
+            self.wfile.write(b'0\r\n\r\n')
+            return
+        buffer = [first, '\n']
+        buffered = len(first) + 1
+        try:
+            for line in lines:
+                buffer.append(line)
+                buffer.append('\n')
+                buffered += len(line) + 1
+                if buffered >= CHUNK_BYTES:
+                    self._chunk(''.join(buffer).encode())
+                    buffer = []
+                    buffered = 0
+        except Exception as e:
+            # the status is sent already, end the response without its last chunk so the client sees it incomplete
+            self.server.service.log(f"{self.path} failed: {e!r}")
+            self.close_connection = True
+            return
+        if buffer:
+            self._chunk(''.join(buffer).encode())
+        self.wfile.write(b'0\r\n\r\n')
+
+
+class TransformServer(http.server.ThreadingHTTPServer):
+    """Serves a TransformService over local HTTP."""
+    daemon_threads = True
+
+    def __init__(self, address, service: TransformService):
+        super().__init__(address, _Handler)
+        self.service = service
+
+
+class UnixTransformServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """Serves a TransformService over HTTP on a Unix socket."""
+    daemon_threads = True
+
+    def __init__(self, path, service: TransformService):
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(path)
+        super().__init__(path, _UnixHandler)
+        self.service = service
+
+    def server_close(self):
+        super().server_close()
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(self.server_address)
+
+
+class _UnixHandler(_Handler):
+    # no TCP_NODELAY on a Unix socket
+    disable_nagle_algorithm = False
+
+    # a Unix socket client has no address
+    def address_string(self):
+        return self.server.server_address
+
+
+@click.command()
+@click.option('--schema', 'schema_path', default="HTAN.model.jsonld", show_default=True, help="HTAN schema (JSON-LD), reloaded when it changes.")
+@click.option('--host', default="127.0.0.1", show_default=True)
+@click.option('--port', default=8765, show_default=True)
+@click.option('--socket', 'socket_path', default=None, help="Listen on this Unix socket instead of host:port.")
+@click.option('--encoder', 'encoder_name', default="json", show_default=True, type=click.Choice(["json", "fast"]),
+              help="json: the stdlib's default format. fast: compact json, with orjson when installed.")
+def cli(schema_path, host, port, socket_path, encoder_name):
+    """Serve the transform of tsv tables POSTed to /transform, with the schema kept loaded."""
+    service = TransformService(schema_path, encoder_name=encoder_name)
+    if socket_path:
+        server = UnixTransformServer(socket_path, service)
+        click.echo(f"Listening on {socket_path}", err=True)
+    else:
+        server = TransformServer((host, port), service)
+        click.echo(f"Listening on http://{host}:{server.server_address[1]}/transform", err=True)
+    # stop on a SIGTERM as on ^C, removing the Unix socket
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+    click.echo(json.dumps(service.status()), err=True)
+
+
+if __name__ == '__main__':
+    cli()
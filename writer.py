@@ -0,0 +1,265 @@
+"""Writes FHIR resources to ndjson files, one set of files per resourceType, see model.main()."""
+import gzip
+import hashlib
+import json
+import os
+import re
+
+# files listed in the manifest of a sharded or compressed output
+MANIFEST = "ndjson.manifest.json"
+
+EXTENSIONS = {None: "", "gzip": ".gz", "zstd": ".zst"}
+
+# {resourceType}[.NNNN].ndjson[.gz|.zst], the files of a resourceType
+NDJSON_NAME = re.compile(r'[A-Z][A-Za-z]*(\.\d{4})?\.ndjson(\.gz|\.zst)?')
+
+
+def encoder(name="json"):
+    """Return a function serializing a resource to a line of ndjson.
+    json: the stdlib's default format.
+    fast: compact, non ascii characters as is. orjson when installed, otherwise the stdlib with the same output.
+    """
+    if name == "json":
+        return json.dumps
+    if name == "fast":
+        try:
+            import orjson
+        except ImportError:
+            return _compact_dumps
+
+        def _orjson_dumps(resource):
+            return orjson.dumps(resource).decode()
+
+        return _orjson_dumps
+    raise ValueError(f"Unknown encoder {name}, expected json or fast")
+
+
+def _compact_dumps(resource):
+    return json.dumps(resource, separators=(',', ':'), ensure_ascii=False)
+
+
+class _HashingFile:
+    """A binary file that keeps the sha256 and size of what is written to it.
+    Given a size, an existing file is reopened, truncated to size, and its content hashed.
+    """
+    def __init__(self, path, size=None):
+        self.sha256 = hashlib.sha256()
+        self.size = 0
+        if size is None:
+            self.file = open(path, "wb")
+            return
+        self.file = open(path, "r+b")
+        self.file.truncate(size)
+        while True:
+            data = self.file.read(1 << 20)
+            if not data:
+                break
+            self.sha256.update(data)
+            self.size += len(data)
+
+    def write(self, data):
+        self.sha256.update(data)
+        self.size += len(data)
+        return self.file.write(data)
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+class _Stream:
+    """The open shard of a resourceType, with its buffered lines."""
+    def __init__(self, resource_type):
+        self.resource_type = resource_type
+        self.shard = 0
+        self.path = None
+        self.name = None
+        self.raw = None
+        self.file = None
+        self.count = 0
+        self.size = 0
+        # bytes written to the shard, size counts characters
+        self.offset = 0
+        self.buffer = []
+        self.buffered = 0
+
+
+class NdjsonWriter:
+    """Buffered writer of the META/{resourceType}.ndjson files.
+    Lines are written in batches of about buffer_bytes. With compression (gzip or zstd) and/or
+    shard_bytes, a resourceType's lines roll over into {resourceType}.0001.ndjson.gz ... shards of
+    about shard_bytes (uncompressed), and MANIFEST lists the files with their counts and checksums.
+    With positions, write() returns the file, byte offset and length of each line, see lookup.IndexWriter.
+    The files of a previous run are left as is, clear() them before a new run into the same directory.
+    """
+    def __init__(self, output_path, compression=None, shard_bytes=None, buffer_bytes=1 << 20, compression_level=None, positions=False):
+        if compression not in EXTENSIONS:
+            raise ValueError(f"Unknown compression {compression}, expected gzip or zstd")
+        if positions and compression:
+            raise ValueError("The positions of lines in compressed files can't be read back, use no compression")
+        if compression == "zstd":
+            try:
+                import zstandard  # noqa: F401
+            except ImportError:
+                raise ValueError("zstd compression needs the zstandard package, pip install zstandard")
+        self.output_path = output_path
+        self.compression = compression
+        self.compression_level = compression_level
+        self.shard_bytes = shard_bytes
+        self.buffer_bytes = buffer_bytes
+        self.positions = positions
+        self.streams = {}
+        self.files = []
+
+    def _path(self, stream: _Stream) -> str:
+        name = stream.resource_type
+        if self.shard_bytes:
+            name = f"{name}.{stream.shard:04d}"
+        return os.path.join(self.output_path, f"{name}.ndjson{EXTENSIONS[self.compression]}")
+
+    def _open(self, stream: _Stream, resumed: dict = None):
+        stream.shard += 1
+        stream.path = self._path(stream)
+        stream.raw = _HashingFile(stream.path, resumed['bytes'] if resumed else None)
+        stream.name = os.path.basename(stream.path)
+        stream.count = resumed['count'] if resumed else 0
+        stream.size = resumed['size'] if resumed else 0
+        stream.offset = stream.raw.size
+        if self.compression == "gzip":
+            # no mtime in the header, so identical content gives identical files
+            level = 6 if self.compression_level is None else self.compression_level
+            stream.file = gzip.GzipFile(fileobj=stream.raw, mode="wb", compresslevel=level, mtime=0)
+        elif self.compression == "zstd":
+            import zstandard
+            level = 3 if self.compression_level is None else self.compression_level
+            stream.file = zstandard.ZstdCompressor(level=level).stream_writer(stream.raw, closefd=False)
+        else:
+            stream.file = stream.raw
+
+    def _flush(self, stream: _Stream):
+        if stream.buffer:
+            stream.file.write(''.join(stream.buffer).encode())
+            stream.buffer = []
+            stream.buffered = 0
+
+    def _close(self, stream: _Stream):
+        self._flush(stream)
+        if stream.file is not stream.raw:
+            stream.file.close()
+        stream.raw.close()
+        self.files.append({
+            'file': stream.name,
+            'resourceType': stream.resource_type,
+            'count': stream.count,
+            'bytes': stream.raw.size,
+            'sha256': stream.raw.sha256.hexdigest(),
+        })
+        stream.file = stream.raw = None
+
+    def write(self, resource_type, line) -> tuple[str, int, int] | None:
+        """Write a line (without its newline) to the resourceType's file.
+        With positions, return the name of the file, and the byte offset and length (without the newline) of the line in it.
+        """
+        stream = self.streams.get(resource_type, None)
+        if stream is None:
+            stream = self.streams[resource_type] = _Stream(resource_type)
+            self._open(stream)
+        size = len(line) + 1
+        if self.shard_bytes and stream.size and stream.size + size > self.shard_bytes:
+            self._close(stream)
+            self._open(stream)
+        stream.buffer.append(line)
+        stream.buffer.append('\n')
+        stream.buffered += size
+        stream.size += size
+        stream.count += 1
+        if stream.buffered >= self.buffer_bytes:
+            self._flush(stream)
+        if self.positions:
+            length = len(line) if line.isascii() else len(line.encode())
+            offset = stream.offset
+            stream.offset += length + 1
+            return stream.name, offset, length
+
+    def checkpoint(self) -> dict:
+        """Flush the files to disk, and return their state, to resume() from it."""
+        if self.compression:
+            raise ValueError("A compressed output can't be resumed, its files end with partial blocks")
+        streams = {}
+        for resource_type, stream in self.streams.items():
+            self._flush(stream)
+            stream.raw.flush()
+            os.fsync(stream.raw.file.fileno())
+            streams[resource_type] = {'shard': stream.shard, 'count': stream.count, 'size': stream.size, 'bytes': stream.raw.size}
+        return {'streams': streams, 'files': list(self.files)}
+
+    def clear(self):
+        """Remove the ndjson files, and MANIFEST, of a previous run in the output directory."""
+        for name in os.listdir(self.output_path):
+            if name == MANIFEST or NDJSON_NAME.fullmatch(name):
+                os.remove(os.path.join(self.output_path, name))
+
+    def resume(self, state: dict):
+        """Reopen the files of a checkpoint(), truncating the lines written after it, and remove the files created after it."""
+        self.files = list(state['files'])
+        self.streams = {}
+        for resource_type, resumed in state['streams'].items():
+            stream = self.streams[resource_type] = _Stream(resource_type)
+            stream.shard = resumed['shard'] - 1
+            self._open(stream, resumed)
+        kept = {_['file'] for _ in self.files} | {_.name for _ in self.streams.values()}
+        for name in os.listdir(self.output_path):
+            if NDJSON_NAME.fullmatch(name) and name not in kept:
+                os.remove(os.path.join(self.output_path, name))
+
+    def close(self):
+        """Close the files, and write the manifest of a sharded or compressed output."""
+        for stream in self.streams.values():
+            self._close(stream)
+        self.streams = {}
+        if self.shard_bytes or self.compression:
+            with open(os.path.join(self.output_path, MANIFEST), "w") as f:
+                json.dump({'files': self.files}, f, indent=2)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class StreamWriter:
+    """Buffered writer of all resourceTypes' lines to one text stream, e.g. stdout, which is left open."""
+    def __init__(self, stream, buffer_bytes=1 << 20):
+        self.stream = stream
+        self.buffer_bytes = buffer_bytes
+        self.buffer = []
+        self.buffered = 0
+        self.counts = {}
+
+    def _flush(self):
+        if self.buffer:
+            self.stream.write(''.join(self.buffer))
+            self.buffer = []
+            self.buffered = 0
+
+    def write(self, resource_type, line):
+        """Write a line (without its newline)."""
+        self.buffer.append(line)
+        self.buffer.append('\n')
+        self.buffered += len(line) + 1
+        self.counts[resource_type] = self.counts.get(resource_type, 0) + 1
+        if self.buffered >= self.buffer_bytes:
+            self._flush()
+
+    def close(self):
+        self._flush()
+        self.stream.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()